@@ -0,0 +1,138 @@
+import hashlib
+import os
+import stat
+import zlib
+from array import array
+from collections import Counter
+from functools import lru_cache
+
+from apps.web.git import get_revision
+from apps.web.paths import resolve_file
+
+# Number of lines before and after the annotated line included in its
+# fingerprint.
+CONTEXT_LINES = 2
+
+
+def get_absolute_path(relative_path):
+    """
+    Return the absolute path of the file, or of its copy if CODE_REVISION is
+    set, None if there is no such file below CODE_DIRECTORY.
+    """
+    try:
+        return resolve_file(relative_path, get_revision())[0]
+    except KeyError:
+        return None
+
+
+@lru_cache(maxsize=16)
+def _read_snapshot(absolute_path, mtime_ns, size):
+    digest = hashlib.sha1()
+    hashes = array('I')
+    with open(absolute_path, 'rb') as f:
+        for raw in f:
+            digest.update(raw)
+            hashes.append(zlib.crc32(raw.strip()))
+    return digest.hexdigest(), hashes
+
+
+def read_snapshot(absolute_path):
+    """
+    Return the digest of the content of the file and the hashes of its lines,
+    ignoring leading and trailing whitespace, or None if there is no such
+    file.
+    """
+    if absolute_path is None:
+        return None
+    try:
+        st = os.stat(absolute_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return _read_snapshot(absolute_path, st.st_mtime_ns, st.st_size)
+
+
+def fingerprint(hashes, index):
+    """
+    Hash the line at the (0-based) index together with the lines around it.
+    """
+    window = hashes[max(index - CONTEXT_LINES, 0):index + CONTEXT_LINES + 1]
+    return hashlib.sha1(window.tobytes()).hexdigest()[:16]
+
+
+def equal_run(old, a, new, b, limit):
+    """
+    Return the number of equal lines starting at old[a] and new[b], at most
+    ``limit``. Slices are compared with a growing step, so long runs of equal
+    lines are compared in C.
+    """
+    length = 0
+    step = 1
+    while length < limit:
+        step = min(step, limit - length)
+        if old[a + length:a + length + step] == new[b + length:b + length + step]:
+            length += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step = 1
+    return length
+
+
+def map_lines(old, new):
+    """
+    Return an array with the index of every old line in the new lines, or -1
+    for the lines which were changed or removed, in linear time.
+
+    The common prefix and suffix are matched first. In between, lines which
+    occur exactly once in both versions are matched as anchors (skipping the
+    ones that would cross an earlier anchor), and the matches are extended to
+    the equal lines around every anchor, like a patience diff without the
+    recursion.
+    """
+    n, m = len(old), len(new)
+    mapping = array('l', [-1]) * n
+    start = equal_run(old, 0, new, 0, min(n, m))
+    mapping[:start] = array('l', range(start))
+    end = equal_run(old[::-1], 0, new[::-1], 0, min(n, m) - start)
+    mapping[n - end:] = array('l', range(m - end, m))
+    end_old, end_new = n - end, m - end
+
+    old_counts = Counter(old[start:end_old])
+    new_counts = Counter(new[start:end_new])
+    new_indexes = dict(zip(new[start:end_new], range(start, end_new)))
+
+    last_new = start - 1
+    i = start
+    while i < end_old:
+        line = old[i]
+        j = new_indexes.get(line)
+        if j is None or j <= last_new or old_counts[line] != 1 or new_counts[line] != 1:
+            i += 1
+            continue
+        # Extend backwards and forwards over the equal lines around the anchor.
+        a, b = i - 1, j - 1
+        while a >= start and b > last_new and mapping[a] == -1 and old[a] == new[b]:
+            mapping[a] = b
+            a, b = a - 1, b - 1
+        length = equal_run(old, i, new, j, min(end_old - i, end_new - j))
+        mapping[i:i + length] = array('l', range(j, j + length))
+        i += length
+        last_new = j + length - 1
+    return mapping
+
+
+def relocate_line(mapping, index, line_count):
+    """
+    Return the new index of the old line at the index. A changed or removed
+    line keeps its distance to the closest unchanged line before it.
+    """
+    if mapping[index] != -1:
+        return mapping[index]
+    previous = index - 1
+    while previous >= 0 and mapping[previous] == -1:
+        previous -= 1
+    new_index = mapping[previous] + index - previous if previous >= 0 else index
+    return max(min(new_index, line_count - 1), 0)
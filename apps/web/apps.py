@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save, pre_save
+
+
+class WebConfig(AppConfig):
+    name = 'apps.web'
+
+    def ready(self):
+        from apps.web import signals
+        from apps.web.models import CodeAnnotation
+
+        pre_save.connect(signals.store_previous_path, sender=CodeAnnotation)
+        pre_save.connect(signals.anchor_annotation, sender=CodeAnnotation)
+        post_save.connect(signals.update_count_on_save, sender=CodeAnnotation)
+        post_delete.connect(signals.update_count_on_delete, sender=CodeAnnotation)
+        post_save.connect(signals.update_search_on_save, sender=CodeAnnotation)
+        post_delete.connect(signals.update_search_on_delete, sender=CodeAnnotation)
@@ -0,0 +1,261 @@
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.urlresolvers import reverse
+
+from apps.web.anchoring import _read_snapshot
+from apps.web.encoding import _detect_encoding
+from apps.web.excerpts import _get_line_index
+
+MANIFEST_NAME = '.benchmark.json'
+
+TEMPLATES = (
+    'class {Name}{n}(object):',
+    '    """',
+    '    Keep the {name} of every {arg} seen so far.',
+    '    """',
+    '    def __init__(self, {arg}, *args, **kwargs):',
+    '        self.{arg} = {arg}',
+    '        self.{name}_{n} = kwargs.pop({arg!r}, {n})',
+    '',
+    '    def {name}(self, {arg}=None):',
+    '        if {arg} is None or {n} > len(self.{arg}):',
+    '            raise ValueError("invalid {name}: %s" % {arg})',
+    '        total = 0',
+    '        for index, item in enumerate(self.{arg}):',
+    '            total += item * {n}  # {name} of {arg}',
+    '        return {{"{name}": total, "count": {n}, "ratio": {n}.5 / (index + 1)}}',
+    '',
+)
+
+WORDS = ('path', 'line', 'annotation', 'lexer', 'token', 'cache', 'window', 'offset', 'directory', 'author',
+         'snapshot', 'marker', 'chunk', 'index', 'stream', 'result')
+
+
+def make_corpus(rng, size=1024 * 1024):
+    """
+    Return about ``size`` bytes of Python-like code and the offsets of its
+    lines, the synthetic files are slices of it.
+    """
+    lines = []
+    length = 0
+    while length < size:
+        name, arg = rng.choice(WORDS), rng.choice(WORDS)
+        values = {'name': name, 'Name': name.title(), 'arg': arg, 'n': rng.randint(0, 9999)}
+        for template in TEMPLATES:
+            line = template.format(**values) + '\n'
+            lines.append(line)
+            length += len(line)
+    corpus = ''.join(lines).encode('utf-8')
+    offsets = [0]
+    for line in lines[:-1]:
+        offsets.append(offsets[-1] + len(line))
+    return corpus, offsets
+
+
+def make_content(rng, corpus, offsets, header, size):
+    """
+    Return about ``size`` bytes of whole lines of the corpus, starting at a
+    random line.
+    """
+    start = offsets[rng.randrange(len(offsets))]
+    data = corpus[start:start + size]
+    while len(data) < size:
+        data += corpus[:size - len(data)]
+    end = data.rfind(b'\n') + 1
+    return header + (data[:end] if end else data)
+
+
+class SyntheticTree(object):
+    """
+    A CODE_DIRECTORY with ``files`` Python files spread over a tree of
+    directories ``depth`` levels deep with ``width`` subdirectories each,
+    plus ``large_files`` files of ``large_file_size`` bytes at the top. The
+    sizes of the other files are spread evenly on a log scale between
+    ``min_size`` and ``max_size``.
+
+    The tree only depends on its parameters and the seed. A manifest with
+    the parameters and the line counts of the files is written at the top,
+    a tree with the same parameters is reused instead of being generated
+    again.
+    """
+    def __init__(self, directory, files=10000, depth=3, width=4, min_size=1024, max_size=16 * 1024,
+                 large_files=1, large_file_size=5 * 1024 * 1024, seed=0):
+        self.directory = directory
+        self.parameters = {
+            'files': files, 'depth': depth, 'width': width, 'min_size': min_size, 'max_size': max_size,
+            'large_files': large_files, 'large_file_size': large_file_size, 'seed': seed,
+        }
+        self.files = []
+        self.directories = []
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def load(self):
+        """
+        Read the manifest, return False if there is none or it was written
+        for other parameters.
+        """
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if manifest['parameters'] != self.parameters:
+            return False
+        self.files = [tuple(f) for f in manifest['files']]
+        self.directories = manifest['directories']
+        return True
+
+    def generate(self, progress=None):
+        rng = random.Random(self.parameters['seed'])
+        corpus, offsets = make_corpus(rng)
+
+        self.directories = ['/']
+        level = ['/']
+        for depth in range(self.parameters['depth']):
+            level = ['{}dir_{}_{}/'.format(parent, depth, i) for parent in level
+                     for i in range(self.parameters['width'])]
+            self.directories += level
+        for directory in self.directories:
+            os.makedirs(os.path.join(self.directory, directory[1:]), exist_ok=True)
+
+        self.files = []
+        sizes = [self.parameters['large_file_size']] * self.parameters['large_files']
+        low, high = self.parameters['min_size'], self.parameters['max_size']
+        sizes += [int(low * (high / low) ** rng.random()) for i in range(self.parameters['files'])]
+        for i, size in enumerate(sizes):
+            if i < self.parameters['large_files']:
+                path = '/large_{}.py'.format(i)
+            else:
+                path = '{}module_{}.py'.format(self.directories[i % len(self.directories)], i)
+            content = make_content(rng, corpus, offsets, '# {}\n'.format(path).encode('utf-8'), size)
+            with open(os.path.join(self.directory, path[1:]), 'wb') as f:
+                f.write(content)
+            self.files.append((path, len(content), content.count(b'\n')))
+            if progress and (i + 1) % 10000 == 0:
+                progress('Generated {} of {} files.'.format(i + 1, len(sizes)))
+
+        with open(self.manifest_path, 'w') as f:
+            json.dump({'parameters': self.parameters, 'files': self.files, 'directories': self.directories}, f)
+
+    def annotation_records(self, count, seed=0):
+        """
+        Return ``count`` (path, line number, annotation) records. Like in a
+        real review, a few files get most annotations.
+        """
+        rng = random.Random(seed)
+        records = []
+        for i in range(count):
+            path, size, lines = self.files[int(len(self.files) * rng.random() ** 3)]
+            records.append((path, rng.randint(1, max(lines, 1)), 'Benchmark annotation {}.'.format(i)))
+        return records
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def rank(p):
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+    return {
+        'min': values[0], 'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': values[-1],
+        'mean': sum(values) / len(values),
+    }
+
+
+def parse_server_timing(header):
+    stages = {}
+    for entry in header.split(','):
+        name, _, duration = entry.strip().partition(';dur=')
+        if duration:
+            stages[name] = float(duration)
+    return stages
+
+
+def clear_caches():
+    """
+    Forget the highlighted files, listings, relocated annotations, snapshots,
+    line indexes and encodings, so the next request is as slow as the first
+    visit of a file.
+    """
+    caches[settings.HIGHLIGHT_CACHE].clear()
+    cache.clear()
+    _read_snapshot.cache_clear()
+    _get_line_index.cache_clear()
+    _detect_encoding.cache_clear()
+
+
+class Benchmark(object):
+    """
+    Run (setup, call) pairs and collect the latency of every call, the
+    stages of the responses sent in the Server-Timing header and, in a
+    second pass with tracemalloc (which slows the calls down), the peak of
+    the memory allocated by every call.
+    """
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.results = {}
+
+    def run(self, name, calls):
+        latencies = []
+        stages = {}
+        for setup, call in calls:
+            setup()
+            start = time.perf_counter()
+            response = call()
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response is not None and response.has_header('Server-Timing'):
+                for stage, duration in parse_server_timing(response['Server-Timing']).items():
+                    stages.setdefault(stage, []).append(duration)
+
+        result = {
+            'count': len(latencies),
+            'latency_ms': percentiles(latencies),
+            'stages_ms': {stage: percentiles(durations) for stage, durations in stages.items()},
+        }
+        if self.memory:
+            peaks = []
+            tracemalloc.start()
+            try:
+                for setup, call in calls:
+                    setup()
+                    tracemalloc.clear_traces()
+                    call()
+                    peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+            finally:
+                tracemalloc.stop()
+            result['memory_kb'] = percentiles(peaks)
+        self.results[name] = result
+        return result
+
+
+def request(client, method, url, data=None, **extra):
+    """
+    Send a request with the test client and read the whole response, like a
+    browser would.
+    """
+    response = getattr(client, method)(url, data, **extra)
+    if response.status_code != 200:
+        raise RuntimeError('{} {} answered {}.'.format(method.upper(), url, response.status_code))
+    if response.streaming:
+        for chunk in response.streaming_content:
+            pass
+    return response
+
+
+def browse_url(directory):
+    return '{}?path={}'.format(reverse('web:browse'), directory)
+
+
+def annotate_url(path):
+    return '{}?path={}'.format(reverse('web:annotate'), path)
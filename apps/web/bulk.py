@@ -0,0 +1,245 @@
+import json
+import os
+from collections import Counter
+from functools import reduce
+from itertools import islice
+from operator import or_
+from urllib.parse import quote, unquote, urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from apps.web.anchoring import fingerprint, get_absolute_path, read_snapshot
+from apps.web.models import AnnotationCount, CodeAnnotation, FileSnapshot
+from apps.web.paths import MAX_PATH_BYTES, is_normalized_path, is_valid_path
+from apps.web.search import index_annotations_after
+
+FORMATS = ('jsonl', 'sarif')
+
+CONTENT_TYPES = {'jsonl': 'application/x-ndjson', 'sarif': 'application/sarif+json'}
+
+SARIF_SCHEMA = 'https://schemastore.azurewebsites.net/schemas/json/sarif-2.1.0-rtm.5.json'
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def parse_record(record, position):
+    """
+    Return the (path, line number, annotation) tuple of an imported record,
+    ``position`` is used in the error messages.
+    """
+    if not isinstance(record, dict):
+        raise InvalidRecord('Record {}: expected an object.'.format(position))
+    path = record.get('path')
+    line_number = record.get('line_number')
+    annotation = record.get('annotation')
+    if not isinstance(path, str) or not is_normalized_path(path):
+        raise InvalidRecord('Record {}: path must be a string starting with / without empty, . or .. '
+                            'components.'.format(position))
+    if not is_valid_path(path):
+        raise InvalidRecord('Record {}: path must be at most {} bytes long.'.format(position, MAX_PATH_BYTES))
+    if not isinstance(line_number, int) or isinstance(line_number, bool) or line_number < 1:
+        raise InvalidRecord('Record {}: line_number must be a positive integer.'.format(position))
+    if not isinstance(annotation, str) or not annotation.strip():
+        raise InvalidRecord('Record {}: annotation must be a non-empty string.'.format(position))
+    return path, line_number, annotation
+
+
+def read_jsonl(lines):
+    """
+    Yield the records of a JSON Lines stream, one object per line.
+    """
+    for position, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise InvalidRecord('Record {}: {}'.format(position, e))
+        yield parse_record(record, position)
+
+
+def parse_sarif_uri(uri, position):
+    """
+    Return the path of the file at the URI of a SARIF artifact location:
+    a relative reference, percent-encoded, or a file: URI below
+    CODE_DIRECTORY.
+    """
+    if not isinstance(uri, str):
+        raise InvalidRecord('Result {}: the artifact location uri must be a string.'.format(position))
+    parts = urlsplit(uri)
+    path = unquote(parts.path)
+    if parts.scheme == 'file':
+        code_directory = os.path.normpath(settings.CODE_DIRECTORY)
+        if not path.startswith(code_directory + '/'):
+            raise InvalidRecord('Result {}: {} is not below the code directory.'.format(position, uri))
+        return path[len(code_directory):]
+    if parts.scheme or parts.netloc:
+        raise InvalidRecord('Result {}: {} is neither a relative nor a file: URI.'.format(position, uri))
+    return '/' + path.lstrip('/')
+
+
+def read_sarif(data):
+    """
+    Yield the records of a SARIF log, one for the first location of every
+    result. SARIF is a single JSON document, so unlike JSON Lines it is read
+    into memory as a whole.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    try:
+        log = json.loads(data)
+    except ValueError as e:
+        raise InvalidRecord('Invalid SARIF log: {}'.format(e))
+    position = 0
+    for run in log.get('runs', []):
+        for result in run.get('results', []):
+            position += 1
+            try:
+                region = result['locations'][0]['physicalLocation']
+                uri = region['artifactLocation']['uri']
+                line_number = region['region']['startLine']
+                text = result['message']['text']
+            except (KeyError, IndexError, TypeError):
+                raise InvalidRecord('Result {}: expected a message text and a physical location with a '
+                                    'start line.'.format(position))
+            if result.get('ruleId'):
+                text = '[{}] {}'.format(result['ruleId'], text)
+            yield parse_record({'path': parse_sarif_uri(uri, position), 'line_number': line_number,
+                                'annotation': text}, position)
+
+
+def read_records(stream, format):
+    if format == 'sarif':
+        return read_sarif(stream.read())
+    return read_jsonl(stream)
+
+
+def find_existing(user, records):
+    """
+    Return the set of (path, line number, annotation) records the user
+    already wrote. The records are looked up a few hundred at a time, to stay
+    below the limit of query parameters of SQLite.
+    """
+    records = list(set(records))
+    existing = set()
+    for i in range(0, len(records), 300):
+        chunk = records[i:i + 300]
+        terms = [Q(path=path, line_number=line_number, annotation=annotation)
+                 for path, line_number, annotation in chunk]
+        existing.update(CodeAnnotation.objects.filter(reduce(or_, terms), user=user).values_list(
+            'path', 'line_number', 'annotation'))
+    return existing
+
+
+def get_anchor(snapshot, line_number):
+    """
+    Return the anchor fields of an annotation of the line, like
+    CodeAnnotation.anchor.
+    """
+    if snapshot is None:
+        return {}
+    digest, hashes = snapshot
+    return {'snapshot': digest, 'fingerprint': fingerprint(hashes, line_number - 1)}
+
+
+def import_annotations(records, user, batch_size=None):
+    """
+    Create an annotation by the user for every (path, line number,
+    annotation) record, skipping the ones the user already wrote. Records are
+    read and written ``batch_size`` at a time so memory use does not depend
+    on the number of records.
+
+    bulk_create does not send the signals keeping the annotation counts and
+    the search index current and anchoring the annotations, this is done
+    here for every batch. Every file is read once per batch, the snapshots
+    are only kept for the batch. Return the number of created and skipped
+    records.
+    """
+    batch_size = batch_size or settings.ANNOTATION_BATCH_SIZE
+    records = iter(records)
+    created = skipped = 0
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return created, skipped
+        existing = find_existing(user, batch)
+        new = []
+        for record in batch:
+            if record in existing:
+                skipped += 1
+                continue
+            existing.add(record)
+            new.append(record)
+
+        paths = {path for path, line_number, annotation in new}
+        snapshots = {path: read_snapshot(get_absolute_path(path)) for path in paths}
+        with transaction.atomic():
+            for digest, hashes in dict(filter(None, snapshots.values())).items():
+                FileSnapshot.objects.store(digest, hashes)
+            last_id = CodeAnnotation.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            CodeAnnotation.objects.bulk_create(
+                CodeAnnotation(path=path, line_number=line_number, user=user, annotation=annotation,
+                               **get_anchor(snapshots[path], line_number))
+                for path, line_number, annotation in new
+            )
+            AnnotationCount.objects.add_paths(Counter(path for path, line_number, annotation in new))
+            index_annotations_after(last_id)
+        created += len(new)
+
+
+def export_annotations(queryset, batch_size=None):
+    """
+    Yield the annotations of the queryset as (path, line number, annotation,
+    username) tuples in the order they were created, reading ``batch_size``
+    at a time.
+    """
+    batch_size = batch_size or settings.ANNOTATION_BATCH_SIZE
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id).order_by('id').values_list(
+            'id', 'path', 'line_number', 'annotation', 'user__username')[:batch_size])
+        if not batch:
+            return
+        for annotation_id, path, line_number, annotation, username in batch:
+            yield path, line_number, annotation, username
+        last_id = batch[-1][0]
+
+
+def write_jsonl(annotations):
+    for path, line_number, annotation, username in annotations:
+        record = {'path': path, 'line_number': line_number, 'annotation': annotation, 'user': username}
+        yield json.dumps(record) + '\n'
+
+
+def write_sarif(annotations):
+    """
+    Yield a SARIF log with a result for every annotation, piece by piece so
+    the whole log is never held in memory.
+    """
+    yield '{{"$schema": {}, "version": "2.1.0", "runs": [{{"tool": {{"driver": {{"name": "code_annotate"}}}}, ' \
+          '"results": ['.format(json.dumps(SARIF_SCHEMA))
+    separator = ''
+    for path, line_number, annotation, username in annotations:
+        yield separator + json.dumps({
+            'level': 'note',
+            'message': {'text': annotation},
+            'locations': [{'physicalLocation': {
+                'artifactLocation': {'uri': quote(path.lstrip('/'))},
+                'region': {'startLine': line_number},
+            }}],
+            'properties': {'user': username},
+        })
+        separator = ', '
+    yield ']}]}\n'
+
+
+def write_records(annotations, format):
+    if format == 'sarif':
+        return write_sarif(annotations)
+    return write_jsonl(annotations)
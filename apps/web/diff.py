@@ -0,0 +1,115 @@
+from itertools import zip_longest
+
+from apps.web.anchoring import map_lines
+from apps.web.highlighting import iter_highlighted
+from apps.web.lexing import decode_line
+
+# Number of lines lexed before a hunk and thrown away, so the state of the
+# lexer (e.g. inside a string) is usually right by the first shown line.
+LEAD_LINES = 50
+
+
+def read_raw_lines(absolute_path):
+    """
+    Return the undecoded lines of the file, or no lines if there is no file
+    (e.g. a file which was added or removed between the revisions).
+    """
+    if absolute_path is None:
+        return []
+    with open(absolute_path, 'rb') as f:
+        return f.readlines()
+
+
+def get_opcodes(old, new):
+    """
+    Return the difference of the lines like difflib.SequenceMatcher.get_opcodes,
+    as (tag, i1, i2, j1, j2) tuples, in linear time (see map_lines).
+    """
+    mapping = map_lines(old, new)
+    # The old lines after which a run of lines mapped to consecutive new
+    # lines ends, only the runs are looked at below.
+    ends = [a for a, (b, following) in enumerate(zip(mapping, mapping[1:]), 1) if following != b + 1 or b == -1]
+    opcodes = []
+    i = j = 0
+    for start, end in zip([0] + ends, ends + [len(old)]):
+        if start == len(old) or mapping[start] == -1:
+            continue
+        b = mapping[start]
+        if start > i or b > j:
+            opcodes.append((change_tag(start - i, b - j), i, start, j, b))
+        i, j = end, b + end - start
+        opcodes.append(('equal', start, i, b, j))
+    if i < len(old) or j < len(new):
+        opcodes.append((change_tag(len(old) - i, len(new) - j), i, len(old), j, len(new)))
+    return opcodes
+
+
+def change_tag(removed, added):
+    return 'replace' if removed and added else 'delete' if removed else 'insert'
+
+
+def group_opcodes(opcodes, context):
+    """
+    Return the hunks of the difference, the changes with ``context`` equal
+    lines around them, like difflib.SequenceMatcher.get_grouped_opcodes.
+    """
+    codes = list(opcodes)
+    if codes and codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes and codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    hunks = []
+    hunk = []
+    for tag, i1, i2, j1, j2 in codes:
+        # Split at long runs of equal lines.
+        if tag == 'equal' and i2 - i1 > context * 2:
+            hunk.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            hunks.append(hunk)
+            hunk = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        hunk.append((tag, i1, i2, j1, j2))
+    hunks.append(hunk)
+    return [hunk for hunk in hunks if any(code[0] != 'equal' for code in hunk)]
+
+
+def highlight_range(lines, start, end, lexer, encoding):
+    """
+    Return the highlighted lines ``start`` to ``end`` (0-based, exclusive) of
+    the undecoded lines, decoded with ``encoding``. Only these lines and a
+    few before them are lexed, the cost does not depend on the size of the
+    file.
+    """
+    if start >= end:
+        return []
+    lead = max(start - LEAD_LINES, 0)
+    decoded = (decode_line(raw, encoding, index == 0) for index, raw in enumerate(lines[lead:end], lead))
+    return list(iter_highlighted(decoded, lexer))[start - lead:]
+
+
+def side_by_side(old, new, lexer, context, old_encoding, new_encoding):
+    """
+    Return the hunks of the difference of the old and new lines as lists of
+    rows, (old line number, old line, new line number, new line, tag)
+    tuples with highlighted lines and None for the missing side of a row.
+    """
+    hunks = []
+    for hunk in group_opcodes(get_opcodes(old, new), context):
+        old_start, old_end = hunk[0][1], hunk[-1][2]
+        new_start, new_end = hunk[0][3], hunk[-1][4]
+        old_lines = highlight_range(old, old_start, old_end, lexer, old_encoding)
+        new_lines = highlight_range(new, new_start, new_end, lexer, new_encoding)
+        rows = []
+        for tag, i1, i2, j1, j2 in hunk:
+            pairs = zip_longest(range(i1, i2), range(j1, j2))
+            for i, j in pairs:
+                rows.append((
+                    None if i is None else i + 1,
+                    None if i is None else old_lines[i - old_start],
+                    None if j is None else j + 1,
+                    None if j is None else new_lines[j - new_start],
+                    tag,
+                ))
+        hunks.append(rows)
+    return hunks
@@ -0,0 +1,73 @@
+import codecs
+import os
+from functools import lru_cache
+
+from django.conf import settings
+
+# The UTF-32 marks come first, the little-endian one starts with the UTF-16
+# little-endian one.
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def sniff_encoding(head):
+    """
+    Return the encoding of a file starting with the given bytes, or None if
+    it looks like a binary file.
+
+    A byte order mark tells the encoding, otherwise a file with a NUL byte
+    is binary. Files without a mark are read with CODE_ENCODING if it is
+    set, as UTF-8 if their start is valid UTF-8 and with
+    CODE_FALLBACK_ENCODING (which decodes any byte) otherwise.
+    """
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    if b'\0' in head:
+        return None
+    if settings.CODE_ENCODING:
+        return settings.CODE_ENCODING
+    try:
+        # Not final, the head may end in the middle of a character.
+        codecs.getincrementaldecoder('utf-8')().decode(head, False)
+    except UnicodeDecodeError:
+        return settings.CODE_FALLBACK_ENCODING
+    return 'utf-8'
+
+
+@lru_cache(maxsize=4096)
+def _detect_encoding(absolute_path, mtime_ns, size):
+    with open(absolute_path, 'rb') as f:
+        return sniff_encoding(f.read(settings.ENCODING_SNIFF_BYTES))
+
+
+def detect_encoding(absolute_path):
+    """
+    Return the encoding of the file from its first ENCODING_SNIFF_BYTES
+    bytes, or None if it is binary. The result is kept per version of the
+    file, the copies of git blobs are named by the hash of their content.
+    """
+    st = os.stat(absolute_path)
+    return _detect_encoding(absolute_path, st.st_mtime_ns, st.st_size)
+
+
+def get_encoding(absolute_path):
+    """
+    Return the encoding to decode the file with, CODE_FALLBACK_ENCODING for
+    a binary file.
+    """
+    return detect_encoding(absolute_path) or settings.CODE_FALLBACK_ENCODING
+
+
+def is_line_encoding(encoding):
+    """
+    Return whether the lines of a file in the encoding can be split at the
+    newline bytes, like the views read them. This leaves out UTF-16 and
+    UTF-32.
+    """
+    return '\n'.encode(encoding) == b'\n'
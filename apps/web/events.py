@@ -0,0 +1,141 @@
+import asyncio
+import json
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from apps.web.git import get_revision
+from apps.web.highlighting import FORMATTER_OPTIONS, Formatter
+from apps.web.models import CodeAnnotation
+from apps.web.paths import resolve_file
+
+
+def get_markers(path, after):
+    """
+    Return the id and the (line number, marker) pairs of the lines of the
+    file which got annotations with an id larger than ``after``, or None if
+    there are none.
+    """
+    close_old_connections()
+    new = list(CodeAnnotation.objects.filter(path=path, id__gt=after).values_list('id', flat=True))
+    if not new:
+        return None
+    try:
+        absolute_path = resolve_file(path, get_revision())[0]
+    except KeyError:
+        absolute_path = None
+    rows = list(CodeAnnotation.objects.file_annotations(path))
+    moved = CodeAnnotation.objects.relocate(absolute_path, rows) if absolute_path else {}
+    formatter = Formatter(CodeAnnotation.objects.for_file(path, absolute_path), 0, **FORMATTER_OPTIONS)
+    lines = sorted({moved.get(row[0], row[1]) for row in rows if row[0] in new})
+    return max(new), [(line_number, formatter.annotation_marker(line_number)) for line_number in lines]
+
+
+def get_last_id():
+    close_old_connections()
+    return CodeAnnotation.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def get_changed_paths(after):
+    close_old_connections()
+    return set(CodeAnnotation.objects.filter(id__gt=after).values_list('path', flat=True))
+
+
+class EventServer(object):
+    """
+    Push new annotations to the open annotate pages as server-sent events.
+
+    Every open page is an idle connection handled by a coroutine, so many of
+    them are cheap. The database is polled once per ``poll_interval`` for all
+    connections together, the queries run in a thread pool as the ORM is
+    blocking.
+    """
+    def __init__(self, poll_interval=None, keepalive=15):
+        self.poll_interval = poll_interval or settings.ANNOTATION_EVENTS_POLL_INTERVAL
+        self.keepalive = keepalive
+        self.subscribers = {}
+        self.last_id = 0
+
+    def run(self, host, port):
+        loop = asyncio.get_event_loop()
+        self.last_id = loop.run_until_complete(loop.run_in_executor(None, get_last_id))
+        server = loop.run_until_complete(asyncio.start_server(self.handle, host, port, loop=loop))
+        poller = asyncio.ensure_future(self.poll(), loop=loop)
+        try:
+            loop.run_forever()
+        finally:
+            poller.cancel()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+
+    async def poll(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            last_id = await loop.run_in_executor(None, get_last_id)
+            if last_id <= self.last_id:
+                continue
+            paths = await loop.run_in_executor(None, get_changed_paths, self.last_id)
+            for path in paths & set(self.subscribers):
+                markers = await loop.run_in_executor(None, get_markers, path, self.last_id)
+                if markers is not None:
+                    for queue in self.subscribers.get(path, ()):
+                        queue.put_nowait(markers)
+            self.last_id = last_id
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            path = query.get('path', [''])[0]
+            if method != 'GET' or not path.startswith('/'):
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+            # EventSource sends the id of the last event it received when it
+            # reconnects, the page passes the last id it rendered the first
+            # time.
+            after = int(headers.get('last-event-id') or query.get('after', ['0'])[0])
+            await self.stream(writer, path, after)
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer, path, after):
+        loop = asyncio.get_event_loop()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Connection: keep-alive\r\n\r\nretry: 5000\n\n')
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(path, set()).add(queue)
+        try:
+            # Send the annotations written between the page load and now.
+            markers = await loop.run_in_executor(None, get_markers, path, after)
+            while True:
+                if markers is None:
+                    writer.write(b': keepalive\n\n')
+                else:
+                    event_id, lines = markers
+                    if event_id > after:
+                        for line_number, marker in lines:
+                            data = json.dumps({'line_number': line_number, 'marker': marker})
+                            writer.write('id: {}\nevent: annotation\ndata: {}\n\n'.format(event_id, data).encode())
+                        after = event_id
+                await writer.drain()
+                try:
+                    markers = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    markers = None
+        finally:
+            self.subscribers[path].discard(queue)
+            if not self.subscribers[path]:
+                del self.subscribers[path]
@@ -0,0 +1,102 @@
+import mmap
+import os
+import stat
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+
+from apps.web.encoding import get_encoding
+from apps.web.lexing import decode_line
+
+# Size in bytes of the blocks of the file with one entry in the line index.
+INDEX_BLOCK_SIZE = 16 * 1024
+
+
+class LineIndex(object):
+    """
+    Sparse index of the lines of a file: the number and byte offset of the
+    last line starting in every block of INDEX_BLOCK_SIZE bytes. Finding a
+    line reads at most one block, whatever the size of the file.
+    """
+    def __init__(self, f, chunk_size=1024 * 1024):
+        # The file is read rather than mapped, mapping would keep all of it
+        # in the memory of the process for a while.
+        self.line_numbers = array('Q', [1])
+        self.offsets = array('Q', [0])
+        count = 0
+        position = 0
+        last = b'\n'
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            for start in range(0, len(chunk), INDEX_BLOCK_SIZE):
+                end = min(start + INDEX_BLOCK_SIZE, len(chunk))
+                newlines = chunk.count(b'\n', start, end)
+                if newlines:
+                    # The last line starting in the block.
+                    self.line_numbers.append(count + newlines + 1)
+                    self.offsets.append(position + chunk.rfind(b'\n', start, end) + 1)
+                count += newlines
+            position += len(chunk)
+            last = chunk[-1:]
+        self.line_count = count if last == b'\n' else count + 1
+
+    def offset(self, data, line_number):
+        """
+        Return the byte offset of the start of the line (1-based).
+        """
+        index = bisect_right(self.line_numbers, line_number) - 1
+        number, offset = self.line_numbers[index], self.offsets[index]
+        while number < line_number:
+            offset = data.find(b'\n', offset) + 1
+            number += 1
+        return offset
+
+
+@lru_cache(maxsize=64)
+def _get_line_index(absolute_path, mtime_ns, size):
+    with open(absolute_path, 'rb') as f:
+        return LineIndex(f)
+
+
+def get_line_index(absolute_path):
+    """
+    Return the line index of the file, built once per version of the file.
+    """
+    st = os.stat(absolute_path)
+    return _get_line_index(absolute_path, st.st_mtime_ns, st.st_size)
+
+
+def read_excerpts(absolute_path, line_numbers, context=0):
+    """
+    Return a dict mapping the line numbers to lists of (line number, line)
+    tuples, the line with ``context`` lines before and after it, or None if
+    there is no such file.
+
+    The file is memory-mapped once for all the excerpts and only the
+    excerpts are read and decoded, so the cost depends on the number of
+    lines asked for and not on the size of the file.
+    """
+    if absolute_path is None or not line_numbers:
+        return None
+    try:
+        st = os.stat(absolute_path)
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        excerpts = {line_number: [] for line_number in line_numbers}
+        if not st.st_size:
+            return excerpts
+        index = get_line_index(absolute_path)
+        encoding = get_encoding(absolute_path)
+        with open(absolute_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for line_number in excerpts:
+                first = max(line_number - context, 1)
+                last = min(line_number + context, index.line_count)
+                offset = index.offset(data, first) if first <= last else len(data)
+                for number in range(first, last + 1):
+                    end = data.find(b'\n', offset)
+                    end = len(data) if end == -1 else end + 1
+                    excerpts[line_number].append((number, decode_line(data[offset:end], encoding, number == 1)
+                                                  .rstrip('\n')))
+                    offset = end
+    except OSError:
+        return None
+    return excerpts
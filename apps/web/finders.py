@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.staticfiles.finders import BaseStorageFinder
+from django.core.files.storage import FileSystemStorage
+from pygments.formatters.html import HtmlFormatter
+
+STYLESHEET_PATH = 'web/pygments.css'
+
+
+class PygmentsStyleFinder(BaseStorageFinder):
+    """
+    Provide the stylesheet of the PYGMENTS_STYLE style as web/pygments.css,
+    so it is collected and fingerprinted like any other static file instead
+    of being inlined in every page.
+
+    The stylesheet is generated once per process, when the finder is created.
+    """
+    def __init__(self, *args, **kwargs):
+        location = os.path.join(tempfile.gettempdir(), 'code_annotate-pygments', settings.PYGMENTS_STYLE)
+        css = HtmlFormatter(style=settings.PYGMENTS_STYLE).get_style_defs('.highlight')
+
+        path = os.path.join(location, STYLESHEET_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a+') as f:
+            f.seek(0)
+            if f.read() != css:
+                f.seek(0)
+                f.truncate()
+                f.write(css)
+
+        super(PygmentsStyleFinder, self).__init__(FileSystemStorage(location=location), *args, **kwargs)
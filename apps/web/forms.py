@@ -0,0 +1,21 @@
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+from apps.web.models import CodeAnnotation
+from apps.web.paths import MAX_PATH_BYTES, is_normalized_path, is_valid_path
+
+
+class CodeAnnotationForm(forms.ModelForm):
+    class Meta:
+        model = CodeAnnotation
+        fields = ('annotation', 'line_number', 'path')
+
+    def clean_path(self):
+        path = self.cleaned_data['path']
+        if not is_normalized_path(path):
+            raise forms.ValidationError(_('The path must start with / and have no empty, . or .. components.'),
+                                        code='invalid')
+        if not is_valid_path(path):
+            raise forms.ValidationError(_('The path must be at most %(max)d bytes long.'), code='max_length',
+                                        params={'max': MAX_PATH_BYTES})
+        return path
@@ -0,0 +1,303 @@
+import hashlib
+import os
+import posixpath
+import queue
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.web.listing import compile_patterns
+
+TREE_MODE = b'40000'
+
+SUBMODULE_MODE = b'160000'
+
+
+class GitError(Exception):
+    pass
+
+
+class CatFile(object):
+    """
+    A long-running ``git cat-file --batch`` (or ``--batch-check``) process,
+    which answers one object name per line of its standard input.
+    """
+    def __init__(self, repository, check=False):
+        self.check = check
+        self.process = subprocess.Popen(
+            ['git', 'cat-file', '--batch-check' if check else '--batch'], cwd=repository,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+
+    def send(self, names):
+        """
+        Write the object names to git, raise GitError if it exited.
+        """
+        for name in names:
+            if '\n' in name:
+                raise KeyError(name)
+        try:
+            self.process.stdin.write(b''.join(name.encode('utf-8', 'surrogateescape') + b'\n' for name in names))
+            self.process.stdin.flush()
+        except OSError:
+            raise GitError('git cat-file exited with {}.'.format(self.process.wait()))
+
+    def read_header(self, name):
+        header = self.process.stdout.readline()
+        if not header:
+            raise GitError('git cat-file exited with {}.'.format(self.process.poll()))
+        fields = header.split()
+        if fields[-1] in (b'missing', b'ambiguous'):
+            raise KeyError(name)
+        return fields[0].decode('ascii'), fields[1].decode('ascii'), int(fields[2])
+
+    def info(self, name):
+        """
+        Return the sha, type and size of the object, or raise KeyError if
+        there is none.
+        """
+        info = self.info_many([name])[0]
+        if info is None:
+            raise KeyError(name)
+        return info
+
+    def info_many(self, names, batch=500):
+        """
+        Return the (sha, type, size) tuples of the objects, or None for the
+        missing ones. The names are sent a few hundred at a time, so git never
+        blocks on a full output pipe while we are still writing.
+        """
+        assert self.check
+        infos = []
+        for i in range(0, len(names), batch):
+            chunk = names[i:i + batch]
+            self.send(chunk)
+            for name in chunk:
+                try:
+                    infos.append(self.read_header(name))
+                except KeyError:
+                    infos.append(None)
+        return infos
+
+    def read(self, name, output=None):
+        """
+        Return the sha, type and content of the object. If ``output`` is
+        given, the content is copied to this file instead of being returned.
+        """
+        assert not self.check
+        self.send([name])
+        sha, object_type, size = self.read_header(name)
+        if output is None:
+            data = self.process.stdout.read(size)
+        else:
+            data = None
+            remaining = size
+            while remaining:
+                block = self.process.stdout.read(min(remaining, 1024 * 1024))
+                if not block:
+                    raise GitError('git cat-file exited with {}.'.format(self.process.poll()))
+                output.write(block)
+                remaining -= len(block)
+        self.process.stdout.read(1)
+        return sha, object_type, data
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            # git already exited, e.g. after an error.
+            pass
+        self.process.wait()
+
+
+class CatFilePool(object):
+    """
+    Reuse at most ``size`` cat-file processes, one per concurrent request, so
+    reading a file does not start a new git process.
+    """
+    def __init__(self, repository, check=False, size=None):
+        self.repository = repository
+        self.check = check
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size or settings.GIT_PROCESSES)
+
+    @contextmanager
+    def process(self):
+        with self.slots:
+            try:
+                cat_file = self.idle.get_nowait()
+            except queue.Empty:
+                cat_file = CatFile(self.repository, self.check)
+            try:
+                yield cat_file
+            except KeyError:
+                self.idle.put(cat_file)
+                raise
+            except BaseException:
+                # The output of the process may be half read.
+                cat_file.close()
+                raise
+            self.idle.put(cat_file)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(repository, check=False):
+    # The pools of a parent process are not inherited by forked workers.
+    key = (os.getpid(), repository, check)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = CatFilePool(repository, check)
+        return _pools[key]
+
+
+def parse_tree(data):
+    """
+    Yield the (mode, name, sha) of the entries of a tree object.
+    """
+    position = 0
+    while position < len(data):
+        space = data.index(b' ', position)
+        end = data.index(b'\0', space)
+        yield data[position:space], data[space + 1:end].decode('utf-8', 'surrogateescape'), \
+            data[end + 1:end + 21].hex()
+        position = end + 21
+
+
+def normalize_path(relative_path):
+    """
+    Return the path relative to the top of CODE_DIRECTORY without the leading
+    and trailing slash, or raise KeyError if it has . or .. components.
+    """
+    parts = [part for part in relative_path.split('/') if part]
+    if '.' in parts or '..' in parts:
+        raise KeyError(relative_path)
+    return '/'.join(parts)
+
+
+class Revision(object):
+    """
+    The files of CODE_DIRECTORY at a commit of its git repository.
+
+    Objects are read through pooled cat-file processes. Trees and blobs never
+    change, so listings are cached by the sha of their tree and blobs are
+    copied once to GIT_BLOB_DIRECTORY, named by their sha, where the views
+    read them like any other file.
+    """
+    def __init__(self, repository, commit):
+        self.repository = repository
+        self.commit = commit
+
+    def object_name(self, relative_path):
+        # The ./ makes git resolve the path relative to CODE_DIRECTORY, which
+        # may be a subdirectory of the repository.
+        return '{}:./{}'.format(self.commit, normalize_path(relative_path))
+
+    def info(self, relative_path):
+        """
+        Return the sha, type and size of the object at the path, or raise
+        KeyError if there is none.
+        """
+        with get_pool(self.repository, check=True).process() as cat_file:
+            return cat_file.info(self.object_name(relative_path))
+
+    def list_directory(self, relative_path):
+        """
+        Return the files and directories of the directory like
+        ``apps.web.listing.list_directory``.
+        """
+        sha, object_type, size = self.info(relative_path)
+        if object_type != 'tree':
+            raise KeyError(relative_path)
+        patterns = tuple(settings.FILE_EXCLUDE_PATTERNS)
+        key = 'tree:{}:{}'.format(sha, hashlib.sha1(repr(patterns).encode('utf-8')).hexdigest())
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+        with get_pool(self.repository).process() as cat_file:
+            data = cat_file.read(sha)[2]
+        exclude = compile_patterns(patterns)
+        # Submodules are commits of other repositories, they are left out.
+        entries = [(mode, name, sha) for mode, name, sha in parse_tree(data)
+                   if mode != SUBMODULE_MODE and not exclude.match(name)]
+        directories = sorted(name for mode, name, sha in entries if mode == TREE_MODE)
+        blobs = [(name, sha) for mode, name, sha in entries if mode != TREE_MODE]
+        with get_pool(self.repository, check=True).process() as cat_file:
+            infos = cat_file.info_many([sha for name, sha in blobs])
+        files = sorted((name, info[2] if info else None) for (name, sha), info in zip(blobs, infos))
+        cache.set(key, (files, directories), None)
+        return files, directories
+
+    def blob_path(self, relative_path):
+        """
+        Return the sha of the file at the path and the absolute path of its
+        copy in GIT_BLOB_DIRECTORY, or raise KeyError if there is no file.
+        """
+        sha, object_type, size = self.info(relative_path)
+        if object_type != 'blob':
+            raise KeyError(relative_path)
+        directory = os.path.join(settings.GIT_BLOB_DIRECTORY, sha[:2])
+        absolute_path = os.path.join(directory, sha[2:])
+        if not os.path.exists(absolute_path):
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+                try:
+                    with get_pool(self.repository).process() as cat_file:
+                        cat_file.read(sha, f)
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+            # The same content always gets the same modification time, so
+            # the caches keyed by the stat of a file are keyed by the blob.
+            os.utime(f.name, ns=(0, 0))
+            os.replace(f.name, absolute_path)
+        return sha, absolute_path
+
+    def walk_files(self, relative_path='/'):
+        """
+        Yield the absolute path of the copy, the relative path and the sha of
+        every file below the directory, like ``apps.web.paths.resolve_file``,
+        without the excluded files and directories.
+        """
+        files, directories = self.list_directory(relative_path)
+        for name, size in files:
+            path = posixpath.join(relative_path, name)
+            try:
+                sha, absolute_path = self.blob_path(path)
+            except KeyError:
+                continue
+            yield absolute_path, path, sha
+        for name in directories:
+            yield from self.walk_files(posixpath.join(relative_path, name))
+
+
+def resolve_revision(name):
+    """
+    Return the revision (commit, branch, tag, ...) of the repository at
+    CODE_DIRECTORY, or raise KeyError if there is no such revision.
+    """
+    repository = settings.CODE_DIRECTORY
+    with get_pool(repository, check=True).process() as cat_file:
+        commit = cat_file.info('{}^{{commit}}'.format(name))[0]
+    return Revision(repository, commit)
+
+
+def get_revision():
+    """
+    Return the CODE_REVISION of CODE_DIRECTORY, or None to use the working
+    tree. The revision is resolved again for every call, a branch shows its
+    latest commit.
+    """
+    if not settings.CODE_REVISION:
+        return None
+    try:
+        return resolve_revision(settings.CODE_REVISION)
+    except KeyError:
+        raise GitError('Unknown revision {}.'.format(settings.CODE_REVISION))
@@ -0,0 +1,296 @@
+import hashlib
+import os
+import time
+from array import array
+from contextlib import contextmanager
+from itertools import islice
+
+import pygments
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.html import escape
+from pygments.formatters.html import HtmlFormatter
+
+from apps.web.lexing import is_resumable, iter_tokens, read_lines
+
+FORMATTER_OPTIONS = {'linenos': 'inline', 'linespans': 'line'}
+
+
+class RenderCache(object):
+    """
+    Store highlighted lines in a Django cache backend, evicting the oldest
+    entries once more than ``max_entries`` are stored.
+
+    The index of the entries lives in the cache itself so it is shared by
+    all workers using the same backend (locmem, file based, ...). It is only
+    written when an entry is stored, so reading an entry never writes to the
+    cache. The updates of the index are serialized with a lock taken with
+    cache.add, otherwise concurrent workers would drop each other's entries
+    from it, and these entries would never be evicted.
+    """
+    index_key = 'highlight:index'
+    lock_key = 'highlight:index:lock'
+    lock_timeout = 10
+    lock_wait = 1
+
+    def __init__(self, cache, max_entries):
+        self.cache = cache
+        self.max_entries = max_entries
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def get_part(self, key, number):
+        return self.cache.get('{}:{}'.format(key, number))
+
+    def set(self, key, value, parts=()):
+        """
+        Store the value, and the ``parts`` (e.g. the lines of a large file
+        split in chunks) to read one by one with get_part. The parts are
+        evicted together with the entry.
+        """
+        self.cache.set_many({'{}:{}'.format(key, number): part for number, part in enumerate(parts)}, None)
+        self.cache.set(key, value, None)
+        with self.lock() as locked:
+            if locked:
+                self._add(key, len(parts))
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the lock of the index while the block runs, the block gets
+        False if the lock could not be taken within ``lock_wait`` seconds.
+        The lock expires after ``lock_timeout`` seconds if its holder dies.
+        """
+        deadline = time.time() + self.lock_wait
+        while not self.cache.add(self.lock_key, True, self.lock_timeout):
+            if time.time() > deadline:
+                yield False
+                return
+            time.sleep(0.01)
+        try:
+            yield True
+        finally:
+            self.cache.delete(self.lock_key)
+
+    def _add(self, key, part_count):
+        index = [entry for entry in self.cache.get(self.index_key) or [] if entry[0] != key]
+        index.append((key, part_count))
+        if len(index) > self.max_entries:
+            self.cache.delete_many([
+                name for evicted, evicted_parts in index[:-self.max_entries]
+                for name in [evicted] + ['{}:{}'.format(evicted, number) for number in range(evicted_parts)]
+            ])
+            index = index[-self.max_entries:]
+        self.cache.set(self.index_key, index, None)
+
+
+def get_render_cache():
+    return RenderCache(caches[settings.HIGHLIGHT_CACHE], settings.HIGHLIGHT_CACHE_MAX_ENTRIES)
+
+
+def get_cache_path(relative_path, blob=None):
+    """
+    Return the path the highlighted lines of a file are cached for. Blobs are
+    cached by their sha, so a file is highlighted once for all the revisions
+    and paths it has the same content in.
+    """
+    return 'blob:' + blob if blob else relative_path
+
+
+def get_cache_key(relative_path, stat, lexer):
+    key = repr((
+        relative_path, stat.st_mtime_ns, stat.st_size, lexer.name, sorted(lexer.options.items()),
+        sorted(FORMATTER_OPTIONS.items()), pygments.__version__, settings.CODE_ENCODING,
+        settings.CODE_FALLBACK_ENCODING,
+    ))
+    return 'highlight:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def iter_highlighted(lines, lexer, stack=('root',), checkpoints=None, chunked=True):
+    """
+    Run the lexer over the lines and yield the highlighted lines, without
+    any wrapping, line numbers or annotations. Unless ``chunked``, the whole
+    text is lexed at once, which is faster for files which fit in memory.
+    """
+    formatter = HtmlFormatter(**FORMATTER_OPTIONS)
+    tokens = iter_tokens(lexer, lines, settings.HIGHLIGHT_CHUNK_LINES if chunked else None, stack, checkpoints)
+    for t, line in formatter._format_lines(tokens):
+        yield line
+
+
+def highlight_lines(absolute_path, relative_path, lexer, info=None):
+    """
+    Return the highlighted lines of the file, from the render cache if the
+    file did not change since it was last highlighted. Whether the cache had
+    them is stored in the ``info`` dict, if given.
+    """
+    key = get_cache_key(relative_path, os.stat(absolute_path), lexer)
+    cache = get_render_cache()
+    lines = cache.get(key)
+    if info is not None:
+        info['cache'] = 'miss' if lines is None else 'hit'
+    if lines is None:
+        # Only files below HIGHLIGHT_STREAMING_THRESHOLD are cached whole.
+        lines = list(iter_highlighted(read_lines(absolute_path), lexer, chunked=False))
+        cache.set(key, lines)
+    return lines
+
+
+def highlight_window(absolute_path, relative_path, lexer, start, end, info=None):
+    """
+    Return the highlighted lines ``start`` to ``end`` (1-based, inclusive).
+
+    Lexing resumes from the closest checkpoint (line number, byte offset,
+    state stack) before the window, the checkpoints found on the way are
+    cached so later windows of the same file do not lex it from the start.
+    Whether the cache had checkpoints is stored in the ``info`` dict, if
+    given.
+
+    Lexers which cannot be resumed (see is_resumable) highlight the whole
+    file once instead, the lines are cached in chunks and the windows are
+    read from these.
+    """
+    if not is_resumable(lexer):
+        return highlight_window_from_chunks(absolute_path, relative_path, lexer, start, end, info)
+    key = get_cache_key(relative_path, os.stat(absolute_path), lexer) + ':checkpoints'
+    cache = get_render_cache()
+    checkpoints = cache.get(key)
+    if info is not None:
+        info['cache'] = 'miss' if checkpoints is None else 'hit'
+    checkpoints = checkpoints or [(0, 0, ('root',))]
+    line, offset, stack = [checkpoint for checkpoint in checkpoints if checkpoint[0] < start][-1]
+
+    offsets = array('Q')
+    found = []
+    # The lines are read lazily, only as far as the lexer needs to be sure
+    # of the tokens of the window.
+    lines = read_lines(absolute_path, offset, offsets=offsets)
+    highlighted = list(islice(iter_highlighted(lines, lexer, stack, found), start - 1 - line, end - line))
+
+    new = [(line + index, offsets[index], found_stack) for index, found_stack in found
+           if line + index > checkpoints[-1][0]]
+    if new:
+        cache.set(key, checkpoints + new)
+    return highlighted
+
+
+def highlight_window_from_chunks(absolute_path, relative_path, lexer, start, end, info=None):
+    """
+    Return the highlighted lines ``start`` to ``end`` (1-based, inclusive)
+    from the whole file highlighted at once, stored in the render cache in
+    chunks of HIGHLIGHT_CHUNK_LINES lines.
+    """
+    key = get_cache_key(relative_path, os.stat(absolute_path), lexer) + ':chunks'
+    cache = get_render_cache()
+    stored = cache.get(key)
+    chunks = None
+    if stored is not None:
+        chunk_lines, chunk_count = stored
+        numbers = range((start - 1) // chunk_lines, min((end - 1) // chunk_lines + 1, chunk_count))
+        chunks = [cache.get_part(key, number) for number in numbers]
+        # The backend may have culled some of the chunks.
+        if None in chunks:
+            chunks = None
+    if info is not None:
+        info['cache'] = 'miss' if chunks is None else 'hit'
+    if chunks is None:
+        chunk_lines = settings.HIGHLIGHT_CHUNK_LINES
+        lines = iter_highlighted(read_lines(absolute_path), lexer, chunked=False)
+        parts = list(iter(lambda: list(islice(lines, chunk_lines)), []))
+        cache.set(key, (chunk_lines, len(parts)), parts)
+        chunks = parts[(start - 1) // chunk_lines:(end - 1) // chunk_lines + 1]
+    first = (start - 1) // chunk_lines * chunk_lines + 1
+    return [line for chunk in chunks for line in chunk][start - first:end - first + 1]
+
+
+def join_chunks(pieces, size=64 * 1024):
+    """
+    Join the pieces into strings of about ``size`` characters, to not send
+    every line separately in a streaming response.
+    """
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class Formatter(HtmlFormatter):
+    def __init__(self, annotations, line_count, max_annotations=None, **options):
+        super(Formatter, self).__init__(**options)
+        self.annotations = annotations
+        self.line_count = line_count
+        self.max_annotations = max_annotations or settings.ANNOTATIONS_PER_LINE
+
+    def iter_lines(self, lines):
+        """
+        Add the line numbers and annotations to already highlighted lines (see
+        ``iter_highlighted``) and yield them.
+        """
+        source = ((1, line) for line in lines)
+        if self.linenos == 2:
+            source = self._wrap_inlinelinenos(source)
+        if self.linespans:
+            source = self._wrap_linespans(source)
+        for t, line in source:
+            yield line
+
+    def stream(self, lines):
+        """
+        Wrap already highlighted lines the same way ``format`` would, merging
+        in the annotations, and yield the pieces.
+        """
+        for t, piece in self.wrap(((1, line) for line in self.iter_lines(lines)), None):
+            yield piece
+
+    def render(self, lines):
+        return ''.join(self.stream(lines))
+
+    def _wrap_inlinelinenos(self, inner):
+        # HtmlFormatter reads all lines to get the width of the line numbers,
+        # use the line count of the file instead to not break streaming and to
+        # have the same width in every window of the file.
+        width = len(str(self.line_count))
+        for number, (t, line) in enumerate(inner, self.linenostart):
+            yield 1, '<span class="lineno">%*s </span>' % (width, number) + line
+
+    def annotation_marker(self, line_number):
+        """
+        Return the marker of the annotations of the line, which opens them in
+        a popover, e.g. to update a single line after an annotation is added.
+        """
+        return self._annotation_marker(self.annotations[line_number])
+
+    def _annotation_marker(self, annotations):
+        items = ['<p><strong>{}</strong>: {}</p>'.format(escape(author), escape(annotation))
+                 for author, annotation in annotations]
+        content = ''.join(items[:self.max_annotations])
+        hidden = items[self.max_annotations:]
+        if hidden:
+            content += '<div class="more-annotations hidden">{}</div>'.format(''.join(hidden))
+            content += '<a href="#" class="show-more-annotations">Show {} more</a>'.format(len(hidden))
+        icon = 'fa-comments' if len(annotations) > 1 else 'fa-comment'
+        return '<span data-toggle="popover" data-container="body" data-placement="left" data-html="true" ' \
+               'data-content="{}" class="annotation"><i class="fa {} fa-fw"> </i> </span>'.format(escape(content), icon)
+
+    def _wrap_linespans(self, inner):
+        s = self.linespans
+        i = self.linenostart - 1
+        for t, line in inner:
+            if t:
+                i += 1
+                if i in self.annotations:
+                    marker = self._annotation_marker(self.annotations[i])
+                    yield 1, '<span id="%s-%d">%s%s</span>' % (s, i, marker, line)
+                else:
+                    yield 1, '<span id="%s-%d"><span class="fa fa-fw"></span> %s</span>' \
+                          % (s, i, line)
+            else:
+                yield 0, line
@@ -0,0 +1,287 @@
+import hashlib
+import os
+from fnmatch import fnmatch
+from functools import lru_cache
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
+from pygments.lexer import RegexLexer
+from pygments.lexers import find_lexer_class, find_lexer_class_for_filename, get_lexer_by_name, guess_lexer
+from pygments.lexers.c_cpp import CFamilyLexer
+from pygments.lexers.special import TextLexer
+from pygments.token import Error, Keyword, Name, Text, _TokenType
+from pygments.util import ClassNotFound
+
+from apps.web.encoding import get_encoding
+
+
+@lru_cache(maxsize=4096)
+def find_lexer_class_for_name(filename):
+    """
+    Return the lexer class for the file name, checking LEXER_OVERRIDES first,
+    or None if the name does not tell. Pygments scans its whole registry for
+    every lookup, so the result is memoized.
+    """
+    for pattern, alias in settings.LEXER_OVERRIDES:
+        if fnmatch(filename, pattern):
+            return type(get_lexer_by_name(alias))
+    return find_lexer_class_for_filename(filename)
+
+
+def guess_lexer_class(absolute_path):
+    """
+    Guess the lexer class from the first LEXER_GUESS_BYTES bytes of the file
+    (e.g. from a shebang), the result is cached by the hash of these bytes.
+    """
+    with open(absolute_path, 'rb') as f:
+        head = f.read(settings.LEXER_GUESS_BYTES)
+    key = 'lexer:' + hashlib.sha1(head).hexdigest()
+    name = cache.get(key)
+    if name is None:
+        text = head.decode(get_encoding(absolute_path), 'replace')
+        try:
+            name = guess_lexer(text).name
+        except ClassNotFound:
+            name = TextLexer.name
+        cache.set(key, name, None)
+    return find_lexer_class(name)
+
+
+def get_lexer(absolute_path, name=None):
+    """
+    Return the lexer for the file, ``name`` is the name to use for the lookup
+    if it is not the name of the file, e.g. for the copy of a git blob.
+    """
+    name = name or os.path.basename(absolute_path)
+    lexer_class = find_lexer_class_for_name(name) or guess_lexer_class(absolute_path)
+    return lexer_class(stripnl=False)
+
+
+def read_lines(absolute_path, offset=0, encoding=None, offsets=None):
+    """
+    Yield the decoded lines of the file starting at the given byte offset,
+    with normalized line endings and without reading the whole file into
+    memory, by default in the encoding detected for the file. If ``offsets``
+    is given, the byte offset of every line read is appended to it.
+    """
+    encoding = encoding or get_encoding(absolute_path)
+    with open(absolute_path, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            if offsets is not None:
+                offsets.append(offset)
+            line = decode_line(raw, encoding, offset == 0)
+            offset += len(raw)
+            yield line
+
+
+def decode_line(raw, encoding, first=False):
+    """
+    Decode a line read from a file with normalized line endings, without
+    the byte order mark of the ``first`` line.
+    """
+    line = raw.decode(encoding, 'replace')
+    if first:
+        line = line.lstrip('\ufeff')
+    if line.endswith('\r\n'):
+        line = line[:-2] + '\n'
+    return line
+
+
+def count_lines(absolute_path):
+    count = 0
+    last = b'\n'
+    with open(absolute_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            count += block.count(b'\n')
+            last = block[-1:]
+    return count if last == b'\n' else count + 1
+
+
+def is_plain_text(lexer):
+    return type(lexer) is TextLexer and not lexer.filters
+
+
+def rename_c_types(lexer, tokens):
+    """
+    Mark the names of the C types as types, like
+    CFamilyLexer.get_tokens_unprocessed does with the tokens of the regular
+    expressions.
+    """
+    for token, value in tokens:
+        if token is Name and (lexer.stdlibhighlighting and value in lexer.stdlib_types or
+                              lexer.c99highlighting and value in lexer.c99_types or
+                              lexer.platformhighlighting and value in lexer.linux_types):
+            token = Keyword.Type
+        yield token, value
+
+
+# Overrides of RegexLexer.get_tokens_unprocessed which only change every
+# token on its own, without any state, and the functions doing the same to
+# the (tokentype, value) pairs of lex_buffer.
+TOKEN_PASSES = {
+    CFamilyLexer.get_tokens_unprocessed: rename_c_types,
+}
+
+
+def is_resumable(lexer):
+    """
+    Only plain regex lexers can be continued from a saved state stack, other
+    lexers keep their state in the generator or in a context object. Regex
+    lexers changing their tokens one by one (see TOKEN_PASSES) can be
+    continued too. Plain text can be continued at any line.
+    """
+    if is_plain_text(lexer):
+        return True
+    get_tokens_unprocessed = type(lexer).get_tokens_unprocessed
+    return isinstance(lexer, RegexLexer) and not lexer.filters and \
+        (get_tokens_unprocessed is RegexLexer.get_tokens_unprocessed or get_tokens_unprocessed in TOKEN_PASSES)
+
+
+def lex_buffer(lexer, text, stack):
+    """
+    Lex the text starting with the given state stack, the same way
+    RegexLexer.get_tokens_unprocessed does.
+
+    Return the (tokentype, value) pairs and a (token count, position, stack)
+    tuple for each position right after a newline, where lexing can be
+    resumed from.
+    """
+    tokens = []
+    boundaries = []
+    pos = 0
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    while 1:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        tokens.append((action, m.group()))
+                    else:
+                        tokens.extend((t, v) for _, t, v in action(lexer, m))
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            if pos >= len(text):
+                break
+            if text[pos] == '\n':
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                tokens.append((Text, '\n'))
+            else:
+                tokens.append((Error, text[pos]))
+            pos += 1
+        if pos and text[pos - 1] == '\n':
+            if boundaries and boundaries[-1][1] == pos:
+                boundaries.pop()
+            boundaries.append((len(tokens), pos, tuple(statestack)))
+    token_pass = TOKEN_PASSES.get(type(lexer).get_tokens_unprocessed)
+    if token_pass is not None:
+        tokens = list(token_pass(lexer, tokens))
+    return tokens, boundaries
+
+
+def iter_tokens(lexer, lines, chunk_lines, stack=('root',), checkpoints=None):
+    """
+    Yield the (tokentype, value) pairs of the lines, lexing ``chunk_lines``
+    lines at a time so memory use does not depend on the size of the file,
+    or the whole text at once if ``chunk_lines`` is None.
+
+    Lexing starts with the given state stack. If ``checkpoints`` is given, a
+    (line index, stack) tuple is appended to it for every line lexing can
+    later be resumed from.
+
+    A regular expression may match differently when the text ends early,
+    e.g. a block comment whose end is not read yet. So the text from the
+    last committed line is lexed again with every new chunk, and tokens are
+    only yielded up to the last line where the new lexing agrees with the
+    previous, shorter one. The result is the same as lexing the whole text
+    unless a single token is longer than ``chunk_lines`` lines, at the cost
+    of lexing every line twice.
+    """
+    if is_plain_text(lexer):
+        # Plain text is a single token, which can be split at every line.
+        for index, line in enumerate(lines):
+            if checkpoints is not None and index and not index % chunk_lines:
+                checkpoints.append((index, ('root',)))
+            yield Text, line if line.endswith('\n') else line + '\n'
+        return
+    if not chunk_lines or not is_resumable(lexer):
+        for token in lexer.get_tokens(''.join(lines)):
+            yield token
+        return
+
+    if lexer.tabsize > 0:
+        lines = (line.expandtabs(lexer.tabsize) for line in lines)
+    lines = iter(lines)
+    size = chunk_lines
+    text = ''
+    previous = None
+    line_index = 0
+    while True:
+        chunk = list(islice(lines, size))
+        text += ''.join(chunk)
+        if len(chunk) < size:
+            if text and not text.endswith('\n'):
+                text += '\n'
+            for token in lex_buffer(lexer, text, stack)[0]:
+                yield token
+            return
+
+        tokens, boundaries = lex_buffer(lexer, text, stack)
+        agreed = find_agreement(previous, tokens, boundaries) if previous is not None else None
+        if agreed is None:
+            # Nothing is certain yet, e.g. inside a long comment. Read more
+            # lines at a time so the text is not lexed again too often.
+            if previous is not None:
+                size *= 2
+            previous = tokens, boundaries
+            continue
+        count, pos, stack = agreed
+        line_index += text.count('\n', 0, pos)
+        if checkpoints is not None:
+            checkpoints.append((line_index, stack))
+        for token in tokens[:count]:
+            yield token
+        text = text[pos:]
+        previous = tokens[count:], [(c - count, p - pos, s) for c, p, s in boundaries if p > pos]
+        size = chunk_lines
+
+
+def find_agreement(previous, tokens, boundaries):
+    """
+    Return the last (token count, position, stack) boundary of the previous
+    lexing of a shorter text which the new lexing has too, with the same
+    tokens before it, or None if there is none.
+    """
+    previous_tokens, previous_boundaries = previous
+    same = 0
+    for old, new in zip(previous_tokens, tokens):
+        if old != new:
+            break
+        same += 1
+    positions = {pos: (count, stack) for count, pos, stack in boundaries}
+    for count, pos, stack in reversed(previous_boundaries):
+        if count <= same and positions.get(pos) == (count, stack):
+            return count, pos, stack
+    return None
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import re
+from fnmatch import translate
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+@lru_cache(maxsize=8)
+def compile_patterns(patterns):
+    """
+    Compile the shell-style patterns into a single regular expression.
+    """
+    if not patterns:
+        return re.compile('(?!)')
+    return re.compile('|'.join(translate(pattern) for pattern in patterns))
+
+
+def is_excluded(name):
+    return compile_patterns(tuple(settings.FILE_EXCLUDE_PATTERNS)).match(name) is not None
+
+
+def walk_files(directory):
+    """
+    Yield the absolute and relative path of every file below the directory,
+    without the excluded files and directories.
+    """
+    directory = os.path.realpath(directory)
+    for parent, directories, files in os.walk(directory):
+        directories[:] = [d for d in directories if not is_excluded(d)]
+        for name in files:
+            absolute_path = os.path.join(parent, name)
+            if is_excluded(name) or not os.path.isfile(absolute_path):
+                continue
+            yield absolute_path, '/' + os.path.relpath(absolute_path, directory)
+
+
+def list_directory(absolute_path, start=0, stop=None):
+    """
+    Return the sorted (name, size) tuples of the files and the sorted names
+    of the directories in the directory, without the excluded ones.
+
+    The listing is cached with the sizes until the modification time of the
+    directory changes. Editing a file in place does not change it, so the
+    sizes of the files shown, ``files[start:stop]``, are read again.
+    """
+    files, directories = scan_directory(absolute_path)
+    files = list(files)
+    for index in range(*slice(start, stop).indices(len(files))):
+        name = files[index][0]
+        files[index] = (name, get_size(os.path.join(absolute_path, name)))
+    return files, directories
+
+
+def get_size(absolute_path):
+    try:
+        return os.stat(absolute_path).st_size
+    except OSError:
+        return None
+
+
+def scan_directory(absolute_path):
+    """
+    Return the sorted (name, size) tuples of the files and the sorted names
+    of the directories in the directory, cached by the modification time of
+    the directory.
+    """
+    mtime = os.stat(absolute_path).st_mtime_ns
+    key = 'directory:' + hashlib.sha1(absolute_path.encode('utf-8', 'surrogateescape')).hexdigest()
+    cached = cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    files = []
+    directories = []
+    exclude = compile_patterns(tuple(settings.FILE_EXCLUDE_PATTERNS))
+    for entry in os.scandir(absolute_path):
+        if exclude.match(entry.name):
+            continue
+        if entry.is_dir():
+            directories.append(entry.name)
+        else:
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = None
+            files.append((entry.name, size))
+    files.sort()
+    directories.sort()
+
+    cache.set(key, (mtime, files, directories), None)
+    return files, directories
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import django
+import pygments
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from apps.web.benchmark import (
+    Benchmark, SyntheticTree, annotate_url, browse_url, clear_caches, request,
+)
+from apps.web.bulk import import_annotations
+from apps.web.highlighting import FORMATTER_OPTIONS, Formatter, highlight_lines
+from apps.web.lexing import get_lexer
+from apps.web.models import CodeAnnotation
+
+
+def size(value):
+    """
+    Parse a number of bytes with an optional K, M or G suffix.
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper()
+    try:
+        if value[-1:] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise CommandError('Invalid size {}.'.format(value))
+
+
+class Command(BaseCommand):
+    help = 'Measure the latency and memory use of the pages on a synthetic code tree and print them as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory',
+                            help='Directory of the synthetic tree, kept and reused by later runs with the same tree '
+                                 'parameters. Defaults to a temporary directory.')
+        parser.add_argument('--files', type=int, default=10000, help='Number of files.')
+        parser.add_argument('--depth', type=int, default=3, help='Number of levels of directories.')
+        parser.add_argument('--width', type=int, default=4, help='Number of subdirectories of every directory.')
+        parser.add_argument('--min-size', type=size, default='1K', help='Size of the smallest files.')
+        parser.add_argument('--max-size', type=size, default='16K', help='Size of the largest files.')
+        parser.add_argument('--large-files', type=int, default=1, help='Number of additional large files.')
+        parser.add_argument('--large-file-size', type=size, default='5M', help='Size of the large files.')
+        parser.add_argument('--annotations', type=int, default=10000, help='Number of annotations.')
+        parser.add_argument('--samples', type=int, default=20, help='Number of requests of every benchmark.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--no-memory', action='store_false', dest='memory',
+                            help='Do not measure the memory use, which runs every benchmark a second time.')
+        parser.add_argument('--output', help='File to write the results to, defaults to the standard output.')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or tempfile.mkdtemp(prefix='code_annotate-benchmark-')
+        os.makedirs(directory, exist_ok=True)
+        tree = SyntheticTree(
+            directory, files=options['files'], depth=options['depth'], width=options['width'],
+            min_size=options['min_size'], max_size=options['max_size'], large_files=options['large_files'],
+            large_file_size=options['large_file_size'], seed=options['seed'],
+        )
+        try:
+            start = time.time()
+            if tree.load():
+                self.log('Reusing the tree in {}.'.format(directory))
+            elif os.listdir(directory):
+                raise CommandError('{} is not empty and was not generated with the same parameters.'.format(
+                    directory))
+            else:
+                self.log('Generating {} files in {}.'.format(options['files'] + options['large_files'], directory))
+                tree.generate(self.log)
+            generate_seconds = time.time() - start
+
+            # The annotations are written to a test database, which is
+            # destroyed at the end.
+            runner = DiscoverRunner(verbosity=0, interactive=False)
+            old_config = runner.setup_databases()
+            # The timings are read from the Server-Timing header, do not log
+            # every request.
+            timing_logger = logging.getLogger('apps.web.timing')
+            level = timing_logger.level
+            timing_logger.setLevel(logging.WARNING)
+            try:
+                # The pages link the static files, which are not collected.
+                with override_settings(CODE_DIRECTORY=directory, ALLOWED_HOSTS=['testserver'], REQUEST_TIMING=True,
+                                       STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'):
+                    results = self.run_benchmarks(tree, options)
+            finally:
+                timing_logger.setLevel(level)
+                runner.teardown_databases(old_config)
+        finally:
+            if not options['directory']:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        results.update({
+            'created': timezone.now().isoformat(),
+            'commit': self.get_commit(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'pygments': pygments.__version__,
+                'database': connection.vendor,
+            },
+            'parameters': dict(tree.parameters, annotations=options['annotations'], samples=options['samples']),
+            'tree': {
+                'files': len(tree.files),
+                'directories': len(tree.directories),
+                'bytes': sum(f[1] for f in tree.files),
+                'lines': sum(f[2] for f in tree.files),
+                'generate_seconds': generate_seconds,
+            },
+        })
+        output = json.dumps(results, indent=2, sort_keys=True) + '\n'
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output, ending='')
+
+    def run_benchmarks(self, tree, options):
+        rng = random.Random(options['seed'])
+        samples = options['samples']
+        user = get_user_model().objects.create_user('benchmark', first_name='Bench', last_name='Mark')
+
+        start = time.time()
+        self.log('Creating {} annotations.'.format(options['annotations']))
+        import_annotations(tree.annotation_records(options['annotations'], options['seed']), user)
+        import_seconds = time.time() - start
+
+        client = Client()
+        client.force_login(user)
+        benchmark = Benchmark(memory=options['memory'])
+        large = [f for f in tree.files if f[0].startswith('/large_')]
+        regular = [f for f in tree.files if not f[0].startswith('/large_')]
+        files = [rng.choice(regular) for i in range(samples)] + large
+
+        def nothing():
+            pass
+
+        def get(url):
+            return lambda: request(client, 'get', url)
+
+        self.log('Browse.')
+        benchmark.run('browse', [(nothing, get(browse_url(rng.choice(tree.directories)))) for i in range(samples)])
+
+        self.log('Annotate, not cached.')
+        benchmark.run('annotate_cold', [(clear_caches, get(annotate_url(f[0]))) for f in files])
+        self.log('Annotate, cached.')
+        benchmark.run('annotate_warm', [(nothing, get(annotate_url(f[0]))) for f in files])
+        self.log('Annotate, largest file, window in the middle.')
+        if large:
+            path, file_size, lines = large[0]
+            benchmark.run('annotate_large_window', [
+                (clear_caches, get('{}&start={}'.format(annotate_url(path), lines // 2)))
+            ])
+
+        def render(annotations, line_count, highlighted):
+            def call():
+                Formatter(annotations, line_count, **FORMATTER_OPTIONS).render(highlighted)
+            return call
+
+        self.log('Formatter.')
+        calls = []
+        for path, file_size, lines in files[:samples]:
+            absolute_path = os.path.join(tree.directory, path[1:])
+            highlighted = highlight_lines(absolute_path, path, get_lexer(absolute_path))
+            calls.append((nothing, render(CodeAnnotation.objects.for_file(path, absolute_path), lines, highlighted)))
+        benchmark.run('formatter', calls)
+
+        self.log('Submit.')
+
+        def submit(data):
+            return lambda: request(client, 'post', reverse('web:submit'), data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        calls = []
+        for i in range(samples):
+            path, file_size, lines = rng.choice(files)
+            data = {'path': path, 'line_number': rng.randint(1, max(lines, 1)), 'annotation': 'Submitted {}.'.format(i)}
+            calls.append((nothing, submit(data)))
+        benchmark.run('submit', calls)
+
+        return {'import_seconds': import_seconds, 'results': benchmark.results}
+
+    def get_commit(self):
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def log(self, message):
+        self.stderr.write(message)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.web.git import get_revision
+from apps.web.paths import walk_code_files
+from apps.web.search import CodeIndex
+
+
+class Command(BaseCommand):
+    help = 'Build or update the index used to search the code of CODE_DIRECTORY (at CODE_REVISION).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes, defaults to the number of CPUs.')
+        parser.add_argument('--compact', action='store_true',
+                            help='Merge the segments of the index after updating it.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        index = CodeIndex()
+        indexed, unchanged, removed = index.update(walk_code_files(get_revision()), options['processes'])
+        if options['compact']:
+            index.compact()
+        self.stdout.write('Updated {} in {:.1f}s: {} files indexed, {} unchanged, {} removed.'.format(
+            index.path, time.time() - start, indexed, unchanged, removed))
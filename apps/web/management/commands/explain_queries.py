@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+
+from apps.web.models import AnnotationCount, CodeAnnotation
+
+
+class Command(BaseCommand):
+    help = 'Show the query plans of the queries run by the browse and annotate pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Annotated file to use in the queries, defaults to the most annotated one.')
+        parser.add_argument('--analyze', action='store_true',
+                            help='Run the queries (EXPLAIN ANALYZE, PostgreSQL only).')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if path is None:
+            path = CodeAnnotation.objects.values_list('path', flat=True) \
+                .annotate(count=Count('id')).order_by('-count').first() or '/'
+        directory = path.rsplit('/', 1)[0] + '/'
+
+        queries = [
+            ('Annotations of a file', CodeAnnotation.objects.file_annotations(path)),
+            ('Annotations below a directory', CodeAnnotation.objects.filter(path__startswith=directory)),
+            ('Annotation counts of a directory',
+             AnnotationCount.objects.filter(directory=directory, count__gt=0).values_list('name', 'count')),
+        ]
+        for title, queryset in queries:
+            sql, params = queryset.query.sql_with_params()
+            self.stdout.write(self.style.MIGRATE_HEADING('{}:'.format(title)))
+            self.stdout.write(sql % tuple(repr(p) for p in params))
+            for line in self.explain(sql, params, options['analyze']):
+                self.stdout.write('    ' + line)
+            self.stdout.write('')
+
+    def explain(self, sql, params, analyze):
+        if connection.vendor == 'postgresql':
+            prefix = 'EXPLAIN ANALYZE ' if analyze else 'EXPLAIN '
+        elif connection.vendor == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
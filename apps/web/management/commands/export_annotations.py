@@ -0,0 +1,29 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.web.bulk import FORMATS, export_annotations, write_records
+from apps.web.models import CodeAnnotation
+
+
+class Command(BaseCommand):
+    help = 'Export the annotations as JSON Lines or SARIF.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?', default='-', help='File to write, defaults to the standard output.')
+        parser.add_argument('--format', choices=FORMATS, default='jsonl')
+        parser.add_argument('--path', default='/', help='Only export the annotations below this path.')
+        parser.add_argument('--batch-size', type=int, default=settings.ANNOTATION_BATCH_SIZE,
+                            help='Number of annotations read at a time.')
+
+    def handle(self, *args, **options):
+        stream = sys.stdout if options['file'] == '-' else open(options['file'], 'w', encoding='utf-8')
+        annotations = export_annotations(CodeAnnotation.objects.filter(path__startswith=options['path']),
+                                         options['batch_size'])
+        try:
+            for piece in write_records(annotations, options['format']):
+                stream.write(piece)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
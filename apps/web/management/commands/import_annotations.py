@@ -0,0 +1,38 @@
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.web.bulk import FORMATS, InvalidRecord, import_annotations, read_records
+
+
+class Command(BaseCommand):
+    help = 'Import annotations from a JSON Lines or SARIF file, e.g. the findings of a linter.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='File to import, - for the standard input.')
+        parser.add_argument('--user', required=True, help='Username of the author of the annotations.')
+        parser.add_argument('--format', choices=FORMATS, default='jsonl')
+        parser.add_argument('--batch-size', type=int, default=settings.ANNOTATION_BATCH_SIZE,
+                            help='Number of annotations read and created at a time.')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        try:
+            user = User.objects.get(**{User.USERNAME_FIELD: options['user']})
+        except User.DoesNotExist:
+            raise CommandError('Unknown user {}.'.format(options['user']))
+
+        start = time.time()
+        stream = sys.stdin if options['file'] == '-' else open(options['file'], encoding='utf-8')
+        try:
+            records = read_records(stream, options['format'])
+            created, skipped = import_annotations(records, user, options['batch_size'])
+        except InvalidRecord as e:
+            raise CommandError(e)
+        finally:
+            stream.close()
+        self.stdout.write('Imported {} annotations in {:.1f}s, skipped {} duplicates.'.format(
+            created, time.time() - start, skipped))
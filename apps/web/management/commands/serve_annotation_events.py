@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from apps.web.events import EventServer
+
+
+class Command(BaseCommand):
+    help = 'Push new annotations to the open annotate pages as server-sent events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+
+    def handle(self, *args, **options):
+        self.stdout.write('Serving annotation events on http://{}:{}/'.format(options['host'], options['port']))
+        try:
+            EventServer().run(options['host'], options['port'])
+        except KeyboardInterrupt:
+            pass
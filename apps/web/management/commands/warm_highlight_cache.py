@@ -0,0 +1,110 @@
+import hashlib
+import os
+import posixpath
+import time
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.web.encoding import detect_encoding, is_line_encoding
+from apps.web.git import get_revision
+from apps.web.highlighting import get_cache_key, get_cache_path, get_render_cache, iter_highlighted
+from apps.web.lexing import count_lines, get_lexer, read_lines
+from apps.web.paths import walk_code_files
+
+MANIFEST_KEY = 'highlight:manifest'
+
+
+def file_digest(absolute_path):
+    digest = hashlib.sha1()
+    with open(absolute_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def highlight_file(args):
+    """
+    Highlight a file in a worker process. The highlighted lines are returned
+    to the main process, which stores them, unless the content did not change
+    since the previous run. The sha of a blob is the digest of its content.
+    """
+    absolute_path, relative_path, blob, key, previous_digest = args
+    digest = blob or file_digest(absolute_path)
+    if digest == previous_digest:
+        return relative_path, key, digest, None
+    lexer = get_lexer(absolute_path, posixpath.basename(relative_path))
+    lines = list(iter_highlighted(read_lines(absolute_path), lexer, chunked=False))
+    return relative_path, key, digest, lines
+
+
+class Command(BaseCommand):
+    help = 'Highlight every file of CODE_DIRECTORY (at CODE_REVISION) and store it in the render cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes, defaults to the number of CPUs.')
+
+    def handle(self, *args, **options):
+        render_cache = get_render_cache()
+        if isinstance(render_cache.cache, LocMemCache):
+            raise CommandError('The {} cache uses the local memory backend which is not shared with the web '
+                               'server processes.'.format(settings.HIGHLIGHT_CACHE))
+
+        start = time.time()
+        manifest = render_cache.cache.get(MANIFEST_KEY) or {}
+        jobs = []
+        cached = 0
+        for absolute_path, relative_path, blob in self.get_files():
+            # Keyed like the annotate page does, by the blob with CODE_REVISION.
+            lexer = get_lexer(absolute_path, posixpath.basename(relative_path))
+            key = get_cache_key(get_cache_path(relative_path, blob), os.stat(absolute_path), lexer)
+            if render_cache.cache.has_key(key):
+                cached += 1
+                continue
+            previous_digest, previous_key = manifest.get(relative_path, (None, None))
+            if previous_key is None or not render_cache.cache.has_key(previous_key):
+                previous_digest = None
+            jobs.append((absolute_path, relative_path, blob, key, previous_digest))
+
+        if len(jobs) > settings.HIGHLIGHT_CACHE_MAX_ENTRIES:
+            self.stderr.write('{} files to highlight but HIGHLIGHT_CACHE_MAX_ENTRIES is {}, only the last ones '
+                              'will stay cached.'.format(len(jobs), settings.HIGHLIGHT_CACHE_MAX_ENTRIES))
+
+        highlighted = unchanged = 0
+        with Pool(options['processes']) as pool:
+            for relative_path, key, digest, lines in pool.imap_unordered(highlight_file, jobs, chunksize=4):
+                if lines is None:
+                    lines = render_cache.cache.get(manifest[relative_path][1])
+                    if lines is None:
+                        continue
+                    unchanged += 1
+                else:
+                    highlighted += 1
+                render_cache.set(key, lines)
+                manifest[relative_path] = (digest, key)
+        render_cache.cache.set(MANIFEST_KEY, manifest, None)
+
+        elapsed = time.time() - start
+        total = highlighted + unchanged + cached
+        self.stdout.write('{} files in {:.1f}s ({:.1f} files/s): {} highlighted, {} unchanged content, '
+                          '{} already cached.'.format(total, elapsed, total / elapsed if elapsed else 0,
+                                                      highlighted, unchanged, cached))
+
+    def get_files(self):
+        """
+        Yield the files the annotate page highlights as a whole, larger files
+        are streamed or shown in windows and not cached, binary files are not
+        shown.
+        """
+        for absolute_path, relative_path, blob in walk_code_files(get_revision()):
+            if os.path.getsize(absolute_path) > settings.HIGHLIGHT_STREAMING_THRESHOLD:
+                continue
+            encoding = detect_encoding(absolute_path)
+            if encoding is None or not is_line_encoding(encoding):
+                continue
+            if settings.ANNOTATE_WINDOW_LINES and count_lines(absolute_path) > settings.ANNOTATE_WINDOW_LINES:
+                continue
+            yield absolute_path, relative_path, blob
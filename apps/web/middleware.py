@@ -0,0 +1,76 @@
+import json
+import logging
+
+from django.conf import settings
+from django.db import connections
+
+from apps.web.timing import Timings, metrics
+
+logger = logging.getLogger('apps.web.timing')
+
+
+class TimingMiddleware(object):
+    """
+    Time the stages of every request (see apps.web.timing), send them in the
+    Server-Timing header and write a log line with the timings and the facts
+    the view recorded. The queries are counted and timed with the debug
+    cursor, whose log Django clears at the start of every request.
+
+    This is done if REQUEST_TIMING or METRICS_ENABLED is set, the metrics
+    are made of the timings.
+    """
+    def process_request(self, request):
+        if not settings.REQUEST_TIMING and not settings.METRICS_ENABLED:
+            return
+        request.timings = Timings()
+        request.debug_cursors = {}
+        for connection in connections.all():
+            request.debug_cursors[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+
+    def process_response(self, request, response):
+        timings = getattr(request, 'timings', None)
+        if timings is None:
+            return response
+        self.add_queries(request, timings)
+        response['Server-Timing'] = timings.server_timing()
+        if response.streaming:
+            # The body is only produced when it is sent, log at the end.
+            response.streaming_content = self.finish_streaming(request, response, response.streaming_content)
+        else:
+            self.finish(request, response)
+        return response
+
+    def add_queries(self, request, timings):
+        queries = [query for connection in connections.all() for query in connection.queries_log]
+        timings.info['queries'] = len(queries)
+        timings.stages['db'] = sum(float(query['time']) for query in queries)
+
+    def finish_streaming(self, request, response, content):
+        timings = request.timings
+        try:
+            with timings.stage('stream'):
+                for chunk in content:
+                    yield chunk
+        finally:
+            self.add_queries(request, timings)
+            self.finish(request, response)
+
+    def finish(self, request, response):
+        for connection in connections.all():
+            connection.force_debug_cursor = request.debug_cursors.get(connection.alias, False)
+        timings = request.timings
+        total = timings.total()
+        view = request.resolver_match.url_name if request.resolver_match else None
+        if settings.METRICS_ENABLED and view:
+            metrics.observe(view, timings, total)
+        record = {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'view': view,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'stages_ms': {stage: round(duration * 1000, 1) for stage, duration in timings.stages.items()},
+        }
+        record.update(timings.info)
+        logger.info(json.dumps(record))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-17 22:35
+from __future__ import unicode_literals
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_annotations(apps, schema_editor):
+    CodeAnnotation = apps.get_model('web', 'CodeAnnotation')
+    AnnotationCount = apps.get_model('web', 'AnnotationCount')
+
+    counts = Counter()
+    for path, count in CodeAnnotation.objects.values_list('path').annotate(Count('id')):
+        directory = '/'
+        for name in path.strip('/').split('/'):
+            counts[directory, name] += count
+            directory += name + '/'
+
+    AnnotationCount.objects.bulk_create(
+        AnnotationCount(directory=directory, name=name, count=count)
+        for (directory, name), count in counts.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('directory', models.CharField(db_index=True, max_length=5000)),
+                ('name', models.CharField(max_length=255)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_annotations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-17 22:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_prefix_index(apps, schema_editor):
+    # Lets PostgreSQL answer path__startswith (LIKE 'prefix%') lookups from an
+    # index, the composite index below only helps with exact lookups.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX web_codeannotation_path_prefix ON web_codeannotation (path text_pattern_ops)'
+        )
+
+
+def drop_prefix_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX web_codeannotation_path_prefix')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0002_annotationcount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='annotationcount',
+            name='directory',
+            field=models.CharField(max_length=5000),
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationcount',
+            index_together=set([('directory', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='codeannotation',
+            index_together=set([('path', 'line_number')]),
+        ),
+        migrations.RunPython(create_prefix_index, drop_prefix_index),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-17 23:10
+from __future__ import unicode_literals
+
+from django.db import DatabaseError, migrations, transaction
+
+
+def create_search_index(apps, schema_editor):
+    # PostgreSQL searches the annotations with an expression index, SQLite
+    # with a full text table kept current by the signal handlers in
+    # apps.web.signals. Other databases fall back to a substring match.
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX web_codeannotation_annotation_search ON web_codeannotation "
+            "USING gin (to_tsvector('simple', annotation))"
+        )
+    elif connection.vendor == 'sqlite':
+        try:
+            with transaction.atomic(using=connection.alias):
+                schema_editor.execute('CREATE VIRTUAL TABLE web_codeannotation_fts USING fts5(annotation)')
+        except DatabaseError:
+            # SQLite was built without FTS5.
+            return
+        schema_editor.execute(
+            'INSERT INTO web_codeannotation_fts (rowid, annotation) SELECT id, annotation FROM web_codeannotation'
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX web_codeannotation_annotation_search')
+    elif schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS web_codeannotation_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0003_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
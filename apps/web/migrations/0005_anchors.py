@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-17 23:20
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import zlib
+from array import array
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Copies of the hashing in apps.web.anchoring as of this migration, which must
+# not change with that module.
+CONTEXT_LINES = 2
+
+
+def read_snapshot(path):
+    # The working tree version of the file, CODE_REVISION is left out so the
+    # migration does not run git. Annotations of files changed since are
+    # relocated from this version like after any other change.
+    code_directory = os.path.realpath(settings.CODE_DIRECTORY) + os.path.sep
+    absolute_path = os.path.realpath(os.path.join(settings.CODE_DIRECTORY, '.' + path))
+    if not path.startswith('/') or not absolute_path.startswith(code_directory) or \
+            not os.path.isfile(absolute_path):
+        return None
+    digest = hashlib.sha1()
+    hashes = array('I')
+    with open(absolute_path, 'rb') as f:
+        for raw in f:
+            digest.update(raw)
+            hashes.append(zlib.crc32(raw.strip()))
+    return digest.hexdigest(), hashes
+
+
+def fingerprint(hashes, index):
+    window = hashes[max(index - CONTEXT_LINES, 0):index + CONTEXT_LINES + 1]
+    return hashlib.sha1(window.tobytes()).hexdigest()[:16]
+
+
+def anchor_annotations(apps, schema_editor):
+    # Existing annotations are anchored to the current version of their file.
+    CodeAnnotation = apps.get_model('web', 'CodeAnnotation')
+    FileSnapshot = apps.get_model('web', 'FileSnapshot')
+
+    for path in CodeAnnotation.objects.values_list('path', flat=True).distinct():
+        current = read_snapshot(path)
+        if current is None:
+            continue
+        digest, hashes = current
+        FileSnapshot.objects.get_or_create(digest=digest, defaults={'line_hashes': hashes.tobytes()})
+        for pk, line_number in CodeAnnotation.objects.filter(path=path).values_list('id', 'line_number'):
+            CodeAnnotation.objects.filter(pk=pk).update(
+                snapshot=digest, fingerprint=fingerprint(hashes, line_number - 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0004_annotation_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40, unique=True)),
+                ('line_hashes', models.BinaryField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='codeannotation',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='codeannotation',
+            name='snapshot',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.RunPython(anchor_annotations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    # Concurrent first annotations of a file could insert two rows for it.
+    AnnotationCount = apps.get_model('web', 'AnnotationCount')
+    duplicates = AnnotationCount.objects.values_list('directory', 'name') \
+        .annotate(rows=Count('id'), total=Sum('count')).filter(rows__gt=1)
+    for directory, name, rows, total in duplicates:
+        ids = list(AnnotationCount.objects.filter(directory=directory, name=name).order_by('id')
+                   .values_list('id', flat=True))
+        AnnotationCount.objects.filter(id__in=ids[1:]).delete()
+        AnnotationCount.objects.filter(id=ids[0]).update(count=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0006_codeannotation_updated'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='annotationcount',
+            unique_together=set([('directory', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='annotationcount',
+            index_together=set([]),
+        ),
+    ]
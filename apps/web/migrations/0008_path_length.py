@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-18 00:22
+from __future__ import unicode_literals
+
+import apps.web.paths
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0007_annotationcount_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='codeannotation',
+            name='path',
+            field=models.CharField(max_length=5000, validators=[apps.web.paths.validate_path_length]),
+        ),
+    ]
@@ -1,12 +1,293 @@
-from django.db import models
+import hashlib
+from array import array
+from collections import Counter
+from functools import reduce
+from operator import and_, or_
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Count, F, Max, Q
 from django.conf import settings
+from django.core.cache import cache
+
+from apps.web.anchoring import fingerprint, get_absolute_path, map_lines, read_snapshot, relocate_line
+from apps.web.paths import validate_path_length
+from apps.web.search import ANNOTATION_SEARCH_TABLE, fts_query, has_annotation_search_table
+
+
+class CodeAnnotationManager(models.Manager):
+    def file_annotations(self, path):
+        return self.filter(path=path).order_by('line_number', 'id').values_list(
+            'id', 'line_number', 'user__first_name', 'user__last_name', 'annotation', 'snapshot', 'fingerprint')
+
+    def for_file(self, path, absolute_path=None):
+        """
+        Return a dict mapping the line numbers of the file to lists of
+        (author, annotation) tuples in the order they were written, loaded
+        together with the authors in one query.
+
+        If the absolute path of the file is given, annotations written on an
+        earlier version of the file are moved to where their line is now.
+        """
+        rows = list(self.file_annotations(path))
+        moved = self.relocate(absolute_path, rows) if absolute_path else {}
+        annotations = {}
+        for pk, line_number, first_name, last_name, annotation, snapshot, line_fingerprint in rows:
+            author = '{} {}'.format(first_name, last_name).strip()
+            annotations.setdefault(moved.get(pk, line_number), []).append((author, annotation))
+        return annotations
+
+    def below(self, prefix, after=None):
+        """
+        Return the annotations of the files below the path prefix ordered by
+        path, line number and id, starting after the (path, line number, id)
+        tuple ``after``. Pages are read by passing the last annotation of the
+        previous page, which the (path, line_number) index answers without
+        counting the skipped annotations.
+        """
+        queryset = self.filter(path__startswith=prefix)
+        if after is not None:
+            path, line_number, pk = after
+            queryset = queryset.filter(Q(path__gt=path) | Q(path=path, line_number__gt=line_number) |
+                                       Q(path=path, line_number=line_number, id__gt=pk))
+        return queryset.order_by('path', 'line_number', 'id')
+
+    def author_counts(self, paths):
+        """
+        Return a dict mapping the paths to lists of (author, count) tuples,
+        the most active authors first, with a single GROUP BY query for a few
+        hundred paths.
+        """
+        paths = list(paths)
+        counts = {}
+        for i in range(0, len(paths), 500):
+            rows = self.filter(path__in=paths[i:i + 500]) \
+                .values_list('path', 'user__first_name', 'user__last_name').annotate(count=Count('id')) \
+                .order_by('path', '-count', 'user__first_name', 'user__last_name')
+            for path, first_name, last_name, count in rows:
+                counts.setdefault(path, []).append(('{} {}'.format(first_name, last_name).strip(), count))
+        return counts
+
+    def last_id(self, path):
+        return self.filter(path=path).aggregate(last_id=Max('id'))['last_id'] or 0
+
+    def version(self, path):
+        """
+        Return the last time an annotation of the file was written or changed
+        and the number of annotations, which together change whenever the
+        annotations of the file do.
+        """
+        version = self.filter(path=path).aggregate(updated=Max('updated'), count=Count('id'))
+        return version['updated'], version['count']
+
+    def relocate(self, absolute_path, rows):
+        """
+        Return a dict mapping the ids of the annotations of ``rows`` whose
+        line moved since they were written to their line number in the
+        current version of the file. The rows start with the id and the line
+        number and end with the snapshot and the fingerprint, like the ones of
+        ``file_annotations``.
+
+        The result is cached for the set of annotations and the version of
+        the file, so the versions are only compared once.
+        """
+        anchors = sorted((row[0], row[1], row[-2], row[-1]) for row in rows if row[-2])
+        current = read_snapshot(absolute_path) if anchors else None
+        if current is None:
+            return {}
+        digest, hashes = current
+        anchors = [anchor for anchor in anchors if anchor[2] != digest]
+        if not anchors:
+            return {}
+
+        key = 'anchors:' + hashlib.sha1(repr((digest, anchors)).encode('utf-8')).hexdigest()
+        moved = cache.get(key)
+        if moved is None:
+            moved = {}
+            snapshots = dict(FileSnapshot.objects.filter(
+                digest__in={snapshot for pk, line_number, snapshot, line_fingerprint in anchors}
+            ).values_list('digest', 'line_hashes'))
+            mappings = {}
+            for pk, line_number, snapshot, line_fingerprint in anchors:
+                index = line_number - 1
+                if index < len(hashes) and fingerprint(hashes, index) == line_fingerprint:
+                    continue
+                if snapshot not in snapshots:
+                    continue
+                if snapshot not in mappings:
+                    old = array('I')
+                    old.frombytes(bytes(snapshots[snapshot]))
+                    mappings[snapshot] = (map_lines(old, hashes), len(old))
+                mapping, old_line_count = mappings[snapshot]
+                if index < old_line_count:
+                    moved[pk] = relocate_line(mapping, index, len(hashes)) + 1
+            cache.set(key, moved, None)
+        return moved
+
+    def current_lines(self, rows):
+        """
+        Return a dict mapping the ids of the (id, line number, path,
+        snapshot, fingerprint) rows of annotations of any files whose line
+        moved to their line number in the current version of their file.
+        """
+        paths = {}
+        for row in rows:
+            paths.setdefault(row[2], []).append(row)
+        moved = {}
+        for path, path_rows in paths.items():
+            absolute_path = get_absolute_path(path)
+            if absolute_path is not None:
+                moved.update(self.relocate(absolute_path, path_rows))
+        return moved
+
+    def search(self, query):
+        """
+        Return the annotations containing all words of the query, using the
+        full text index of the database where there is one (see migration
+        0004) and a slow substring match otherwise.
+        """
+        if not query.split():
+            return self.none()
+        if connections[self.db].vendor == 'postgresql':
+            return self.extra(where=["to_tsvector('simple', annotation) @@ plainto_tsquery('simple', %s)"],
+                              params=[query])
+        if has_annotation_search_table(self.db):
+            return self.extra(where=['web_codeannotation.id IN (SELECT rowid FROM {0} WHERE {0} MATCH %s)'.format(
+                ANNOTATION_SEARCH_TABLE)], params=[fts_query(query)])
+        return self.filter(reduce(and_, (Q(annotation__icontains=word) for word in query.split())))
 
 
 class CodeAnnotation(models.Model):
-    path = models.CharField(max_length=5000)
+    path = models.CharField(max_length=5000, validators=[validate_path_length])
     line_number = models.PositiveIntegerField()
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     annotation = models.TextField()
+    # Digest of the version of the file the line number refers to, and hash
+    # of the line with its context in that version, see apps.web.anchoring.
+    snapshot = models.CharField(max_length=40, blank=True, default='')
+    fingerprint = models.CharField(max_length=16, blank=True, default='')
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = CodeAnnotationManager()
+
+    class Meta:
+        index_together = [('path', 'line_number')]
 
     def __str__(self):
         return '{}: {}'.format(self.path, self.line_number)
+
+    def anchor(self):
+        """
+        Anchor the annotation to its line in the current version of the file.
+        """
+        current = read_snapshot(get_absolute_path(self.path))
+        if current is None:
+            self.snapshot = self.fingerprint = ''
+            return
+        digest, hashes = current
+        FileSnapshot.objects.store(digest, hashes)
+        self.snapshot = digest
+        self.fingerprint = fingerprint(hashes, self.line_number - 1)
+
+
+class FileSnapshotManager(models.Manager):
+    def store(self, digest, hashes):
+        self.get_or_create(digest=digest, defaults={'line_hashes': hashes.tobytes()})
+
+
+class FileSnapshot(models.Model):
+    """
+    Hashes of the lines of a version of an annotated file, used to move the
+    annotations written on it when the file changes.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    line_hashes = models.BinaryField()
+
+    objects = FileSnapshotManager()
+
+    def __str__(self):
+        return self.digest
+
+
+def split_path(path):
+    """
+    Return a (directory, name) tuple for the annotated file and each of its
+    parent directories, e.g. '/a/b.py' gives ('/', 'a') and ('/a/', 'b.py').
+    """
+    directory = '/'
+    nodes = []
+    for name in path.strip('/').split('/'):
+        nodes.append((directory, name))
+        directory += name + '/'
+    return nodes
+
+
+class AnnotationCountManager(models.Manager):
+    def add(self, path, delta):
+        self.add_paths({path: delta})
+
+    def add_paths(self, deltas):
+        """
+        Add the deltas of a {path: delta} dict to the counts of the files and
+        their parent directories, with one query per file or directory.
+        """
+        nodes = Counter()
+        for path, delta in deltas.items():
+            for node in split_path(path):
+                nodes[node] += delta
+        with transaction.atomic():
+            missing = []
+            for (directory, name), delta in nodes.items():
+                if not delta:
+                    continue
+                updated = self.filter(directory=directory, name=name).update(count=F('count') + delta)
+                if not updated and delta > 0:
+                    missing.append(self.model(directory=directory, name=name, count=delta))
+            if missing:
+                self.create_missing(missing)
+            decreased = [Q(directory=d, name=n) for (d, n), delta in nodes.items() if delta < 0]
+            if decreased:
+                self.filter(reduce(or_, decreased), count__lte=0).delete()
+
+    def create_missing(self, rows):
+        """
+        Insert the counts of files and directories which had none. Another
+        transaction may insert some of them first, they are then added to
+        its rows, which the unique (directory, name) constraint keeps single.
+        """
+        try:
+            with transaction.atomic():
+                self.bulk_create(rows)
+            return
+        except IntegrityError:
+            pass
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    row.save(force_insert=True)
+            except IntegrityError:
+                self.filter(directory=row.directory, name=row.name).update(count=F('count') + row.count)
+
+    def for_directory(self, directory):
+        """
+        Return a dict mapping the names of the files and directories in the
+        given directory to the number of annotations below them.
+        """
+        return dict(self.filter(directory=directory, count__gt=0).values_list('name', 'count'))
+
+
+class AnnotationCount(models.Model):
+    """
+    Number of annotations of a file or below a directory, kept current by the
+    signal handlers in apps.web.signals.
+    """
+    directory = models.CharField(max_length=5000)
+    name = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+
+    objects = AnnotationCountManager()
+
+    class Meta:
+        unique_together = [('directory', 'name')]
+
+    def __str__(self):
+        return '{}{}: {}'.format(self.directory, self.name, self.count)
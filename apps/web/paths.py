@@ -0,0 +1,78 @@
+import os
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext_lazy as _
+
+from apps.web.git import normalize_path
+from apps.web.listing import walk_files
+
+# Longest path (in UTF-8 bytes) an annotation may have. PostgreSQL cannot
+# store btree index entries larger than about 2700 bytes, and the path is
+# indexed alone, with the line number, with text_pattern_ops for the prefix
+# lookups and, split in a directory and a name, in the annotation counts.
+MAX_PATH_BYTES = 2000
+
+
+def resolve_file(path, revision=None):
+    """
+    Return the absolute path of the file at ``path`` (relative to
+    CODE_DIRECTORY, with a leading slash), its normalized relative path and
+    the sha of its blob, or raise KeyError if there is no such file below
+    CODE_DIRECTORY.
+
+    With a revision (see ``apps.web.git.get_revision``) the absolute path is
+    the one of the copy of the blob, otherwise the sha is None.
+    """
+    if not path.startswith('/'):
+        raise KeyError(path)
+    if revision is not None:
+        blob, absolute_path = revision.blob_path(path)
+        return absolute_path, '/' + normalize_path(path), blob
+
+    code_directory = os.path.realpath(settings.CODE_DIRECTORY) + os.path.sep
+    absolute_path = os.path.realpath(os.path.join(settings.CODE_DIRECTORY, '.' + path))
+    # Symbolic links and .. components may lead out of CODE_DIRECTORY.
+    if not absolute_path.startswith(code_directory) or not os.path.isfile(absolute_path):
+        raise KeyError(path)
+    return absolute_path, '/' + absolute_path[len(code_directory):], None
+
+
+def walk_code_files(revision=None):
+    """
+    Yield the absolute path, relative path and blob sha of every file of
+    CODE_DIRECTORY like ``resolve_file``, at the revision if one is given.
+    """
+    if revision is not None:
+        yield from revision.walk_files()
+        return
+    for absolute_path, relative_path in walk_files(settings.CODE_DIRECTORY):
+        yield absolute_path, relative_path, None
+
+
+def is_normalized_path(path):
+    """
+    Return whether the path is written like the views store it, with a
+    leading slash and without empty, . or .. components, so it cannot lead
+    out of CODE_DIRECTORY.
+    """
+    return path.startswith('/') and '\0' not in path and \
+        all(part not in ('', '.', '..') for part in path.split('/')[1:])
+
+
+def is_valid_path(path):
+    """
+    Return whether annotations may be stored for the path: it is normalized
+    and at most MAX_PATH_BYTES long.
+    """
+    return is_normalized_path(path) and len(path.encode('utf-8', 'surrogateescape')) <= MAX_PATH_BYTES
+
+
+def validate_path_length(path):
+    """
+    Validator of the annotation path, the CharField of the model only counts
+    characters and is longer for the existing rows.
+    """
+    if len(path.encode('utf-8', 'surrogateescape')) > MAX_PATH_BYTES:
+        raise ValidationError(_('The path must be at most %(max)d bytes long.'), code='max_length',
+                              params={'max': MAX_PATH_BYTES})
@@ -0,0 +1,268 @@
+import os
+import sqlite3
+from array import array
+from collections import defaultdict
+from functools import lru_cache
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.db import connections
+
+from apps.web.git import GitError
+from apps.web.lexing import read_lines
+from apps.web.paths import resolve_file
+
+ANNOTATION_SEARCH_TABLE = 'web_codeannotation_fts'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    blob TEXT
+);
+CREATE TABLE IF NOT EXISTS postings (
+    trigram INTEGER NOT NULL,
+    segment INTEGER NOT NULL,
+    files BLOB NOT NULL,
+    PRIMARY KEY (trigram, segment)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+@lru_cache(maxsize=None)
+def has_annotation_search_table(using='default'):
+    """
+    The SQLite full text table is only created if SQLite was built with FTS5,
+    see migration 0004.
+    """
+    connection = connections[using]
+    return connection.vendor == 'sqlite' and ANNOTATION_SEARCH_TABLE in connection.introspection.table_names()
+
+
+def fts_query(query):
+    """
+    Quote every word of the query, so FTS5 matches the lines containing all
+    of them and does not interpret operators.
+    """
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def index_annotation(pk, annotation, using='default'):
+    if has_annotation_search_table(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM {} WHERE rowid = %s'.format(ANNOTATION_SEARCH_TABLE), [pk])
+            cursor.execute('INSERT INTO {} (rowid, annotation) VALUES (%s, %s)'.format(ANNOTATION_SEARCH_TABLE),
+                           [pk, annotation])
+
+
+def unindex_annotation(pk, using='default'):
+    if has_annotation_search_table(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM {} WHERE rowid = %s'.format(ANNOTATION_SEARCH_TABLE), [pk])
+
+
+def index_annotations_after(pk, using='default'):
+    """
+    Index the annotations with an id larger than ``pk`` which are not indexed
+    yet, used after bulk_create which does not send post_save.
+    """
+    if has_annotation_search_table(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('INSERT INTO {0} (rowid, annotation) SELECT id, annotation FROM web_codeannotation '
+                           'WHERE id > %s AND id NOT IN (SELECT rowid FROM {0})'.format(ANNOTATION_SEARCH_TABLE), [pk])
+
+
+def trigrams(data):
+    """
+    Return the distinct trigrams of the bytes as integers, ignoring the case
+    of ASCII letters.
+    """
+    data = data.lower()
+    # Converting only the distinct slices is about twice as fast.
+    return {int.from_bytes(gram, 'big') for gram in {data[i:i + 3] for i in range(len(data) - 2)}}
+
+
+def extract_trigrams(args):
+    """
+    Read a file in a worker process and return its sorted trigrams, or None
+    for binary files.
+    """
+    absolute_path, relative_path, version = args
+    try:
+        with open(absolute_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return relative_path, version, None
+    if b'\0' in data[:8192]:
+        return relative_path, version, None
+    return relative_path, version, array('I', sorted(trigrams(data))).tobytes()
+
+
+class CodeIndex(object):
+    """
+    Trigram index of the files of CODE_DIRECTORY (at CODE_REVISION), stored
+    in an SQLite database at SEARCH_INDEX_PATH.
+
+    For every trigram the index stores the ids of the files containing it,
+    a query only reads the files containing all trigrams of the searched
+    text. Updates are incremental: changed files get a new id and their
+    postings are appended as a new segment, the postings of the old ids are
+    ignored until the segments are compacted.
+    """
+    def __init__(self, path=None):
+        self.path = path or settings.SEARCH_INDEX_PATH
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.executescript(SCHEMA)
+        # Indexes built before revisions were indexed have no blob column.
+        if 'blob' not in [row[1] for row in connection.execute('PRAGMA table_info(files)')]:
+            connection.execute('ALTER TABLE files ADD COLUMN blob TEXT')
+        return connection
+
+    def update(self, files, processes=None, segment_files=5000):
+        """
+        Index the new and changed files of the (absolute path, relative path,
+        blob sha) tuples of ``apps.web.paths.walk_code_files`` and drop the
+        files which are gone. The copies of blobs all have the same
+        modification time, they are told apart by their sha. Return the number
+        of indexed, unchanged and removed files.
+        """
+        connection = self.connect()
+        known = {path: (mtime_ns, size, blob) for path, mtime_ns, size, blob in
+                 connection.execute('SELECT path, mtime_ns, size, blob FROM files')}
+        jobs = []
+        unchanged = 0
+        for absolute_path, relative_path, blob in files:
+            stat = os.stat(absolute_path)
+            version = (stat.st_mtime_ns, stat.st_size, blob)
+            if known.pop(relative_path, None) == version:
+                unchanged += 1
+            elif stat.st_size <= settings.SEARCH_MAX_FILE_SIZE:
+                jobs.append((absolute_path, relative_path, version))
+        connection.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in known))
+
+        postings = defaultdict(lambda: array('I'))
+        pending = 0
+        with Pool(processes) as pool:
+            for relative_path, version, grams in pool.imap_unordered(extract_trigrams, jobs, chunksize=16):
+                # Binary files are recorded too, so they are not read again
+                # by the next update, but have no postings.
+                connection.execute('DELETE FROM files WHERE path = ?', (relative_path,))
+                file_id = connection.execute('INSERT INTO files (path, mtime_ns, size, blob) VALUES (?, ?, ?, ?)',
+                                             (relative_path,) + version).lastrowid
+                if grams is None:
+                    continue
+                for gram in array('I', grams):
+                    postings[gram].append(file_id)
+                pending += 1
+                if pending >= segment_files:
+                    self.write_segment(connection, postings)
+                    postings.clear()
+                    pending = 0
+        if postings:
+            self.write_segment(connection, postings)
+        connection.commit()
+
+        if self.get_meta(connection, 'segments') > settings.SEARCH_INDEX_MAX_SEGMENTS:
+            self.compact(connection)
+        connection.close()
+        return len(jobs), unchanged, len(known)
+
+    def get_meta(self, connection, key):
+        row = connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def write_segment(self, connection, postings):
+        segment = self.get_meta(connection, 'segments') + 1
+        connection.executemany('INSERT INTO postings (trigram, segment, files) VALUES (?, ?, ?)',
+                               ((gram, segment, ids.tobytes()) for gram, ids in postings.items()))
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('segments', segment))
+
+    def compact(self, connection=None):
+        """
+        Merge all segments into one, without the ids of removed or changed
+        files.
+        """
+        connection = connection or self.connect()
+        live = {file_id for file_id, in connection.execute('SELECT id FROM files')}
+        connection.execute('DROP TABLE IF EXISTS postings_compact')
+        connection.execute('CREATE TABLE postings_compact (trigram INTEGER NOT NULL, segment INTEGER NOT NULL, '
+                           'files BLOB NOT NULL, PRIMARY KEY (trigram, segment)) WITHOUT ROWID')
+
+        def merged():
+            current, ids = None, array('I')
+            for gram, blob in connection.execute('SELECT trigram, files FROM postings ORDER BY trigram, segment'):
+                if gram != current:
+                    if ids:
+                        yield current, 0, array('I', sorted(set(ids) & live)).tobytes()
+                    current, ids = gram, array('I')
+                ids.frombytes(blob)
+            if ids:
+                yield current, 0, array('I', sorted(set(ids) & live)).tobytes()
+
+        # A separate cursor is used to write, the merge reads the postings
+        # table while the rows are inserted.
+        connection.cursor().executemany('INSERT INTO postings_compact (trigram, segment, files) VALUES (?, ?, ?)',
+                                        (row for row in merged() if row[2]))
+        connection.execute('DROP TABLE postings')
+        connection.execute('ALTER TABLE postings_compact RENAME TO postings')
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('segments', 0))
+        connection.commit()
+        connection.execute('VACUUM')
+
+    def candidates(self, connection, text):
+        """
+        Return the ids of the files containing every trigram of the text.
+        """
+        found = None
+        for gram in trigrams(text.encode('utf-8')):
+            ids = array('I')
+            for blob, in connection.execute('SELECT files FROM postings WHERE trigram = ?', (gram,)):
+                ids.frombytes(blob)
+            found = set(ids) if found is None else found & set(ids)
+            if not found:
+                break
+        return found or set()
+
+    def search(self, text, limit=None, revision=None):
+        """
+        Return the (relative path, line number, line) tuples of the lines
+        containing the text, ignoring case, reading the files at the revision
+        if one is given. Texts shorter than three characters have no trigrams
+        and never match.
+        """
+        limit = limit or settings.SEARCH_MAX_RESULTS
+        if not self.exists():
+            return []
+        connection = self.connect()
+        ids = list(self.candidates(connection, text))
+        paths = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            paths += [path for path, in connection.execute(
+                'SELECT path FROM files WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk)]
+        connection.close()
+
+        needle = text.lower()
+        results = []
+        for relative_path in sorted(paths):
+            try:
+                absolute_path = resolve_file(relative_path, revision)[0]
+                for number, line in enumerate(read_lines(absolute_path), 1):
+                    if needle in line.lower():
+                        results.append((relative_path, number, line.rstrip('\n')))
+                        if len(results) >= limit:
+                            return results
+            except (KeyError, GitError, OSError):
+                continue
+        return results
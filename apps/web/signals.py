@@ -0,0 +1,41 @@
+from apps.web.models import AnnotationCount, CodeAnnotation
+from apps.web.search import index_annotation, unindex_annotation
+
+
+def store_previous_path(sender, instance, raw, **kwargs):
+    instance._previous_path = instance._previous_line_number = None
+    if instance.pk and not raw:
+        instance._previous_path, instance._previous_line_number = CodeAnnotation.objects.filter(
+            pk=instance.pk).values_list('path', 'line_number').first() or (None, None)
+
+
+def anchor_annotation(sender, instance, raw, **kwargs):
+    # Runs after store_previous_path. The line number of an annotation which
+    # was not moved may refer to an earlier version of the file, it keeps its
+    # anchor.
+    if raw:
+        return
+    if not instance.snapshot or (instance.path, instance.line_number) != \
+            (instance._previous_path, instance._previous_line_number):
+        instance.anchor()
+
+
+def update_count_on_save(sender, instance, created, raw, **kwargs):
+    previous_path = getattr(instance, '_previous_path', None)
+    if created:
+        AnnotationCount.objects.add(instance.path, 1)
+    elif previous_path is not None and previous_path != instance.path:
+        AnnotationCount.objects.add(previous_path, -1)
+        AnnotationCount.objects.add(instance.path, 1)
+
+
+def update_count_on_delete(sender, instance, **kwargs):
+    AnnotationCount.objects.add(instance.path, -1)
+
+
+def update_search_on_save(sender, instance, raw, using, **kwargs):
+    index_annotation(instance.pk, instance.annotation, using)
+
+
+def update_search_on_delete(sender, instance, using, **kwargs):
+    unindex_annotation(instance.pk, using)
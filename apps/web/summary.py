@@ -0,0 +1,142 @@
+import csv
+import json
+
+from django.conf import settings
+
+from apps.web.anchoring import get_absolute_path
+from apps.web.excerpts import read_excerpts
+from apps.web.models import CodeAnnotation
+
+FORMATS = ('csv', 'json')
+
+CONTENT_TYPES = {'csv': 'text/csv', 'json': 'application/json'}
+
+CSV_COLUMNS = ('path', 'line_number', 'author', 'annotation', 'excerpt')
+
+
+def parse_cursor(cursor):
+    """
+    Parse a ``line_number:id:path`` page cursor, or raise ValueError.
+    """
+    line_number, pk, path = cursor.split(':', 2)
+    return path, int(line_number), int(pk)
+
+
+def format_cursor(path, line_number, pk):
+    return '{}:{}:{}'.format(line_number, pk, path)
+
+
+def read_page(prefix, after=None, limit=None):
+    """
+    Return the annotations of a page below the path prefix as (id, path,
+    line number, author, annotation, snapshot, fingerprint) tuples, and the
+    (path, line number, id) of the last one if there is a next page, None
+    otherwise. The pages are ordered by the line numbers the annotations
+    were written on.
+    """
+    limit = limit or settings.SUMMARY_PAGE_SIZE
+    rows = list(CodeAnnotation.objects.below(prefix, after).values_list(
+        'id', 'path', 'line_number', 'user__first_name', 'user__last_name', 'annotation', 'snapshot',
+        'fingerprint')[:limit + 1])
+    rows = [(pk, path, line_number, '{} {}'.format(first_name, last_name).strip(), annotation, snapshot,
+             line_fingerprint)
+            for pk, path, line_number, first_name, last_name, annotation, snapshot, line_fingerprint in rows]
+    if len(rows) <= limit:
+        return rows, None
+    pk, path, line_number = rows[limit - 1][:3]
+    return rows[:limit], (path, line_number, pk)
+
+
+def summarize(rows, context=None):
+    """
+    Group the annotations by file with the number of annotations of every
+    author of the file (across all pages) and an excerpt of the annotated
+    lines, read without reading the rest of the file. Annotations written on
+    an earlier version of a file are shown on their current line.
+    """
+    context = settings.SUMMARY_EXCERPT_CONTEXT if context is None else context
+    files = []
+    for row in rows:
+        path = row[1]
+        if not files or files[-1]['path'] != path:
+            files.append({'path': path, 'annotations': [], 'rows': []})
+        files[-1]['rows'].append((row[0], row[2]) + row[3:])
+
+    counts = CodeAnnotation.objects.author_counts(f['path'] for f in files)
+    for f in files:
+        f['authors'] = [{'author': author, 'count': count} for author, count in counts.get(f['path'], [])]
+        f['count'] = sum(author['count'] for author in f['authors'])
+        absolute_path = get_absolute_path(f['path'])
+        rows = f.pop('rows')
+        moved = CodeAnnotation.objects.relocate(absolute_path, rows) if absolute_path else {}
+        f['annotations'] = sorted(
+            ({'line_number': moved.get(pk, line_number), 'author': author, 'annotation': annotation}
+             for pk, line_number, author, annotation, snapshot, line_fingerprint in rows),
+            key=lambda annotation: annotation['line_number'])
+        excerpts = read_excerpts(absolute_path, {a['line_number'] for a in f['annotations']}, context) or {}
+        for annotation in f['annotations']:
+            annotation['excerpt'] = [{'line_number': number, 'line': line}
+                                     for number, line in excerpts.get(annotation['line_number'], [])]
+    return files
+
+
+def iter_files(prefix, batch_size=None):
+    """
+    Yield the summaries of all files below the path prefix, reading
+    ``batch_size`` annotations at a time.
+    """
+    batch_size = batch_size or settings.ANNOTATION_BATCH_SIZE
+    after = None
+    pending = None
+    while True:
+        rows, after = read_page(prefix, after, batch_size)
+        for f in summarize(rows):
+            # The annotations of a file may be split over two pages.
+            if pending is not None and pending['path'] == f['path']:
+                pending['annotations'] += f['annotations']
+                continue
+            if pending is not None:
+                yield pending
+            pending = f
+        if after is None:
+            break
+    if pending is not None:
+        yield pending
+
+
+class Echo(object):
+    """
+    A file-like object returning what is written to it, to stream the rows
+    written by csv.writer.
+    """
+    def write(self, value):
+        return value
+
+
+def write_csv(files):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for f in files:
+        for annotation in f['annotations']:
+            excerpt = '\n'.join(line['line'] for line in annotation['excerpt']
+                                if line['line_number'] == annotation['line_number'])
+            yield writer.writerow((f['path'], annotation['line_number'], annotation['author'],
+                                   annotation['annotation'], excerpt))
+
+
+def write_json(files):
+    """
+    Yield a JSON list of the file summaries piece by piece.
+    """
+    yield '['
+    separator = ''
+    for f in files:
+        yield separator + json.dumps(f)
+        separator = ', '
+    yield ']\n'
+
+
+def write_summary(files, format):
+    if format == 'csv':
+        return write_csv(files)
+    return write_json(files)
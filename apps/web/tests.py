@@ -0,0 +1,608 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.http import http_date
+from pygments.lexers import CLexer, JavaLexer, PythonLexer, RubyLexer
+from pygments.lexers.special import TextLexer
+
+from apps.web.anchoring import map_lines, read_snapshot
+from apps.web.bulk import (
+    InvalidRecord, export_annotations, import_annotations, read_jsonl, read_sarif, write_records,
+)
+from apps.web.diff import get_opcodes
+from apps.web.encoding import is_line_encoding, sniff_encoding
+from apps.web.excerpts import LineIndex, read_excerpts
+from apps.web.git import CatFile, CatFilePool, GitError, get_revision, resolve_revision
+from apps.web.highlighting import RenderCache, highlight_window, iter_highlighted
+from apps.web.lexing import is_resumable, iter_tokens
+from apps.web.models import AnnotationCount, CodeAnnotation
+from apps.web.paths import resolve_file, walk_code_files
+from apps.web.search import CodeIndex
+
+
+def java_lines(line_count, comment_start, comment_lines):
+    """
+    Return the lines of a Java file with a block comment of ``comment_lines``
+    lines starting at line ``comment_start``, holding code and a quote.
+    """
+    lines = []
+    while len(lines) < line_count:
+        if len(lines) + 1 == comment_start:
+            lines.append('/* start of comment\n')
+            lines += [' * int x = {}; "q\n'.format(i) for i in range(comment_lines - 2)]
+            lines.append(' */\n')
+        else:
+            lines.append('int v{0} = {0}; // c\n'.format(len(lines) + 1))
+    return lines
+
+
+def c_lines(line_count):
+    """
+    Return the lines of a C file using standard and C99 types, which the C
+    lexer renames after lexing.
+    """
+    lines = []
+    while len(lines) < line_count:
+        lines += ['/* function {}\n'.format(len(lines)), ' * size_t */\n',
+                  'int32_t f{}(size_t n, FILE *f) {{\n'.format(len(lines)), '    return (int32_t) n;\n', '}\n']
+    return lines[:line_count]
+
+
+def merge_tokens(tokens):
+    """
+    Join the consecutive tokens of the same type, lexing in chunks may split
+    a token where lexing at once does not.
+    """
+    merged = []
+    for token_type, value in tokens:
+        if merged and merged[-1][0] == token_type:
+            merged[-1] = (token_type, merged[-1][1] + value)
+        else:
+            merged.append((token_type, value))
+    return merged
+
+
+class LexingTests(SimpleTestCase):
+    def assertSameTokens(self, lexer, lines, chunk_lines):
+        self.assertEqual(merge_tokens(iter_tokens(lexer, lines, chunk_lines)),
+                         merge_tokens(lexer.get_tokens(''.join(lines))))
+
+    def test_comment_across_chunks(self):
+        # The comment starts before the boundary of the first chunk and ends
+        # after it.
+        self.assertSameTokens(JavaLexer(stripnl=False), java_lines(1602, 701, 400), 1000)
+
+    def test_comment_across_small_chunks(self):
+        self.assertSameTokens(JavaLexer(stripnl=False), java_lines(5000, 990, 30), 100)
+
+    def test_python(self):
+        lines = ['def f{}():\n    """\n    doc {}\n    """\n    return 1\n\n'.format(i, i) for i in range(300)]
+        lines = ''.join(lines).splitlines(True)
+        self.assertSameTokens(PythonLexer(stripnl=False), lines, 7)
+
+    def test_c(self):
+        lexer = CLexer(stripnl=False)
+        self.assertTrue(is_resumable(lexer))
+        self.assertSameTokens(lexer, c_lines(1000), 64)
+
+    def test_not_resumable(self):
+        self.assertFalse(is_resumable(RubyLexer(stripnl=False)))
+
+    def test_plain_text(self):
+        lines = ['line {}\n'.format(i) for i in range(250)]
+        self.assertSameTokens(TextLexer(stripnl=False), lines, 100)
+
+    @override_settings(HIGHLIGHT_CHUNK_LINES=100)
+    def test_iter_highlighted(self):
+        lines = java_lines(1000, 250, 60)
+        lexer = JavaLexer(stripnl=False)
+        self.assertEqual(list(iter_highlighted(lines, lexer)), list(iter_highlighted(lines, lexer, chunked=False)))
+
+
+@override_settings(HIGHLIGHT_CHUNK_LINES=500)
+class HighlightWindowTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lines = java_lines(1602, 701, 400)
+        caches['highlight'].clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertWindows(self, name, lexer, lines=None):
+        lines = lines or self.lines
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+        full = list(iter_highlighted(lines, lexer, chunked=False))
+        # The later windows resume from the checkpoints cached by the earlier
+        # ones.
+        for start, end in [(1, 50), (690, 720), (1000, 1100), (1500, 1602), (650, 1200), (30, 40)]:
+            info = {}
+            self.assertEqual(highlight_window(path, '/' + name, lexer, start, end, info), full[start - 1:end])
+        self.assertEqual(info['cache'], 'hit')
+
+    def test_java(self):
+        self.assertWindows('Window.java', JavaLexer(stripnl=False))
+
+    def test_c(self):
+        self.assertWindows('window.c', CLexer(stripnl=False), c_lines(1602))
+
+    def test_not_resumable(self):
+        # Highlighted once and read from the cached chunks.
+        lines = ['def f{}(x)\n  "#{{x}}"\nend\n'.format(i) for i in range(534)]
+        lines = ''.join(lines).splitlines(True)
+        with mock.patch('apps.web.highlighting.iter_highlighted', side_effect=iter_highlighted) as highlight:
+            self.assertWindows('window.rb', RubyLexer(stripnl=False), lines)
+        self.assertEqual(highlight.call_count, 1)
+
+    def test_plain_text(self):
+        self.assertWindows('window.txt', TextLexer(stripnl=False))
+
+
+class MapLinesTests(SimpleTestCase):
+    def test_equal(self):
+        self.assertEqual(list(map_lines(list('abc'), list('abc'))), [0, 1, 2])
+
+    def test_insert_and_remove(self):
+        self.assertEqual(list(map_lines(list('abcdef'), list('xabdefy'))), [1, 2, -1, 3, 4, 5])
+
+    def test_moved_block_is_not_crossed(self):
+        # Only one of the two blocks can keep its order.
+        mapping = map_lines(list('abcdxyz'), list('xyzabcd'))
+        self.assertEqual(sum(1 for index in mapping if index != -1), 4)
+
+    def test_repeated_lines(self):
+        self.assertEqual(list(map_lines(list('aaxaa'), list('aaaa'))), [0, 1, -1, 2, 3])
+
+    def test_opcodes(self):
+        old, new = list('abcdef'), list('abXdeYf')
+        opcodes = get_opcodes(old, new)
+        self.assertEqual(opcodes, [
+            ('equal', 0, 2, 0, 2), ('replace', 2, 3, 2, 3), ('equal', 3, 5, 3, 5), ('insert', 5, 5, 5, 6),
+            ('equal', 5, 6, 6, 7),
+        ])
+
+    def test_opcodes_rebuild_new(self):
+        old = ['line {}\n'.format(i) for i in range(100)]
+        new = old[:10] + ['added\n'] + old[10:40] + old[45:90] + ['changed\n'] + old[91:]
+        rebuilt = []
+        for tag, i1, i2, j1, j2 in get_opcodes(old, new):
+            rebuilt += old[i1:i2] if tag == 'equal' else new[j1:j2]
+        self.assertEqual(rebuilt, new)
+
+    def test_opcodes_of_empty_files(self):
+        self.assertEqual(get_opcodes([], ['a']), [('insert', 0, 0, 0, 1)])
+        self.assertEqual(get_opcodes(['a'], []), [('delete', 0, 1, 0, 0)])
+
+
+class LineIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.data = ''.join('line {}{}\n'.format(i, 'x' * (i % 300)) for i in range(1, 20001)).encode('ascii')
+
+    def test_offsets(self):
+        index = LineIndex(BytesIO(self.data), chunk_size=50000)
+        self.assertEqual(index.line_count, 20000)
+        offsets = [0] + [i + 1 for i, byte in enumerate(self.data) if byte == ord('\n')]
+        for line_number in (1, 2, 100, 5000, 12345, 20000):
+            self.assertEqual(index.offset(self.data, line_number), offsets[line_number - 1])
+
+    def test_last_line_without_newline(self):
+        self.assertEqual(LineIndex(BytesIO(b'a\nb')).line_count, 2)
+        self.assertEqual(LineIndex(BytesIO(b'')).line_count, 0)
+
+    def test_read_excerpts(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.data)
+            f.flush()
+            excerpts = read_excerpts(f.name, {1, 15000, 20000}, context=1)
+        self.assertEqual(excerpts[1], [(1, 'line 1x'), (2, 'line 2xx')])
+        self.assertEqual(excerpts[15000], [(i, 'line {}{}'.format(i, 'x' * (i % 300))) for i in (14999, 15000, 15001)])
+        self.assertEqual([number for number, line in excerpts[20000]], [19999, 20000])
+
+
+@override_settings(CODE_DIRECTORY=tempfile.gettempdir(), CODE_REVISION='')
+class AnnotationCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+
+    def annotate(self, path):
+        return CodeAnnotation.objects.create(path=path, line_number=1, user=self.user, annotation='Note.')
+
+    def test_add_move_and_remove(self):
+        first = self.annotate('/a/b.py')
+        self.annotate('/a/b.py')
+        self.annotate('/a/c/d.py')
+        self.assertEqual(AnnotationCount.objects.for_directory('/'), {'a': 3})
+        self.assertEqual(AnnotationCount.objects.for_directory('/a/'), {'b.py': 2, 'c': 1})
+
+        first.path = '/a/c/e.py'
+        first.save()
+        self.assertEqual(AnnotationCount.objects.for_directory('/a/'), {'b.py': 1, 'c': 2})
+        self.assertEqual(AnnotationCount.objects.for_directory('/a/c/'), {'d.py': 1, 'e.py': 1})
+
+        first.delete()
+        self.assertEqual(AnnotationCount.objects.for_directory('/a/c/'), {'d.py': 1})
+        self.assertFalse(AnnotationCount.objects.filter(directory='/a/c/', name='e.py').exists())
+
+    def test_create_missing_adds_to_existing_rows(self):
+        # Rows inserted by another transaction since add_paths looked for them.
+        self.annotate('/a.py')
+        AnnotationCount.objects.create_missing([
+            AnnotationCount(directory='/', name='a.py', count=2),
+            AnnotationCount(directory='/', name='b.py', count=1),
+        ])
+        self.assertEqual(AnnotationCount.objects.for_directory('/'), {'a.py': 3, 'b.py': 1})
+        self.assertEqual(AnnotationCount.objects.filter(directory='/', name='a.py').count(), 1)
+
+
+class RenderCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = caches['highlight']
+        self.backend.clear()
+        self.cache = RenderCache(self.backend, 2)
+
+    def test_oldest_entries_are_evicted(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, [key])
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('c'), ['c'])
+        self.assertEqual(self.backend.get(RenderCache.index_key), [('b', 0), ('c', 0)])
+
+    def test_parts_are_evicted_with_their_entry(self):
+        self.cache.set('a', 2, [['a0'], ['a1']])
+        self.assertEqual(self.cache.get_part('a', 1), ['a1'])
+        self.cache.set('b', 0)
+        self.cache.set('c', 0)
+        self.assertIsNone(self.cache.get_part('a', 0))
+        self.assertIsNone(self.cache.get_part('a', 1))
+
+    def test_get_does_not_write(self):
+        self.cache.set('a', ['a'])
+        with mock.patch.object(self.backend, 'set') as set:
+            self.assertEqual(self.cache.get('a'), ['a'])
+        self.assertFalse(set.called)
+
+    def test_lock(self):
+        with self.cache.lock() as locked:
+            self.assertTrue(locked)
+            with mock.patch.object(RenderCache, 'lock_wait', 0):
+                with self.cache.lock() as locked_again:
+                    self.assertFalse(locked_again)
+        with self.cache.lock() as locked:
+            self.assertTrue(locked)
+
+
+class TreeViewTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for i in range(15):
+            os.mkdir(os.path.join(self.directory, 'd{:02}'.format(i)))
+        for i in range(6):
+            with open(os.path.join(self.directory, 'f{}.py'.format(i)), 'w') as f:
+                f.write('x' * i)
+        settings = override_settings(CODE_DIRECTORY=self.directory, CODE_REVISION='', TREE_PAGE_SIZE=10)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_nodes(self, offset):
+        with mock.patch('apps.web.views.AnnotationCount.objects.for_directory', return_value={}):
+            response = self.client.get(reverse('web:tree'), {'path': '/', 'offset': offset})
+        self.assertEqual(response.json()['total'], 21)
+        return [(node['name'], node.get('size')) for node in response.json()['nodes']]
+
+    def test_pages_cross_from_directories_to_files(self):
+        nodes = self.get_nodes(0) + self.get_nodes(10) + self.get_nodes(20)
+        self.assertEqual(nodes, [('d{:02}'.format(i), None) for i in range(15)] +
+                         [('f{}.py'.format(i), i) for i in range(6)])
+
+    def test_sizes_are_current(self):
+        self.get_nodes(10)
+        # Editing a file in place does not change its directory.
+        with open(os.path.join(self.directory, 'f0.py'), 'w') as f:
+            f.write('changed')
+        self.assertEqual(self.get_nodes(10)[5], ('f0.py', 7))
+
+
+class GitTests(SimpleTestCase):
+    def setUp(self):
+        self.repository = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.repository, 'sub'))
+        with open(os.path.join(self.repository, 'sub', 'a.py'), 'w') as f:
+            f.write('print(1)\n')
+        git = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com']
+        for command in (['init', '-q'], ['add', '.'], ['commit', '-q', '-m', 'Add a.py']):
+            subprocess.check_call(git + command, cwd=self.repository)
+
+    def tearDown(self):
+        shutil.rmtree(self.repository)
+
+    def test_read(self):
+        pool = CatFilePool(self.repository, size=1)
+        with pool.process() as cat_file:
+            sha, object_type, data = cat_file.read('HEAD:sub/a.py')
+        self.assertEqual((object_type, data), ('blob', b'print(1)\n'))
+        # A missing object leaves the process usable.
+        with self.assertRaises(KeyError):
+            with pool.process() as cat_file:
+                cat_file.read('HEAD:missing.py')
+        with pool.process() as reused:
+            self.assertIs(reused, cat_file)
+            self.assertEqual(reused.read('HEAD:sub/a.py')[2], b'print(1)\n')
+
+    def test_revision(self):
+        with override_settings(CODE_DIRECTORY=self.repository, GIT_BLOB_DIRECTORY=self.repository + '/.blobs'):
+            revision = resolve_revision('HEAD')
+            self.assertEqual(revision.list_directory('/'), ([], ['sub']))
+            self.assertEqual(revision.list_directory('/sub/'), ([('a.py', 9)], []))
+            with open(revision.blob_path('/sub/a.py')[1]) as f:
+                self.assertEqual(f.read(), 'print(1)\n')
+            with self.assertRaises(KeyError):
+                resolve_revision('no-such-branch')
+
+    def test_search_revision(self):
+        index = CodeIndex(os.path.join(self.repository, '.index'))
+        git = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com']
+        with override_settings(CODE_DIRECTORY=self.repository, CODE_REVISION='HEAD',
+                               GIT_BLOB_DIRECTORY=self.repository + '/.blobs'):
+            self.assertEqual(index.update(walk_code_files(get_revision()), processes=1), (1, 0, 0))
+            # The working tree is neither indexed nor searched.
+            with open(os.path.join(self.repository, 'sub', 'a.py'), 'w') as f:
+                f.write('print(2)\n')
+            self.assertEqual(index.search('print(1)', revision=get_revision()), [('/sub/a.py', 1, 'print(1)')])
+            self.assertEqual(index.update(walk_code_files(get_revision()), processes=1), (0, 1, 0))
+            # The copy of the new blob has the same size and time.
+            subprocess.check_call(git + ['commit', '-q', '-a', '-m', 'Change a.py'], cwd=self.repository)
+            self.assertEqual(index.update(walk_code_files(get_revision()), processes=1), (1, 0, 0))
+            self.assertEqual(index.search('print(1)', revision=get_revision()), [])
+            self.assertEqual(index.search('print(2)', revision=get_revision()), [('/sub/a.py', 1, 'print(2)')])
+
+    def test_not_a_repository(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.assertRaises(GitError):
+            with CatFilePool(directory, check=True).process() as cat_file:
+                cat_file.info('HEAD')
+
+    def test_close_after_exit(self):
+        cat_file = CatFile(tempfile.gettempdir())
+        cat_file.process.wait()
+        # Left in the buffer, written when the pipe is closed.
+        cat_file.process.stdin.write(b'HEAD\n')
+        cat_file.close()
+
+
+class DiffViewTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'a.py'), 'w') as f:
+            f.write('print(1)\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_not_a_repository(self):
+        with override_settings(CODE_DIRECTORY=self.directory, CODE_REVISION=''):
+            response = self.client.get(reverse('web:diff'), {'path': '/a.py', 'from': 'HEAD'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_without_git(self):
+        with override_settings(CODE_DIRECTORY=self.directory, CODE_REVISION=''), \
+                mock.patch('apps.web.git.subprocess.Popen', side_effect=FileNotFoundError('git')):
+            response = self.client.get(reverse('web:diff'), {'path': '/a.py', 'from': 'HEAD'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'a.py'), 'w') as f:
+            f.write('print(1)\nprint(2)\n')
+        settings = override_settings(CODE_DIRECTORY=self.directory, CODE_REVISION='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create(username='user')
+        self.url = reverse('web:annotate') + '?path=/a.py'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def annotate(self, line_number):
+        return CodeAnnotation.objects.create(path='/a.py', line_number=line_number, user=self.user, annotation='Note.')
+
+    def test_unchanged_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_annotation(self):
+        etag = self.client.get(self.url)['ETag']
+        self.annotate(1)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_deleted_annotation(self):
+        self.annotate(1)
+        newest = self.annotate(2)
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Last-Modified'))
+        newest.delete()
+        # The latest update is now earlier than when the page was served.
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200)
+
+
+class BulkTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'a b.py'), 'w') as f:
+            f.write('print(1)\nprint(2)\n')
+        settings = override_settings(CODE_DIRECTORY=self.directory, CODE_REVISION='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create(username='user')
+        self.other = User.objects.create(username='other')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_import_skips_existing(self):
+        CodeAnnotation.objects.create(path='/a b.py', line_number=1, user=self.user, annotation='One.')
+        CodeAnnotation.objects.create(path='/a b.py', line_number=2, user=self.other, annotation='Two.')
+        records = [('/a b.py', 1, 'One.'), ('/a b.py', 2, 'Two.'), ('/a b.py', 2, 'Two.'), ('/c.py', 1, 'Three.')]
+        self.assertEqual(import_annotations(records, self.user, batch_size=2), (2, 2))
+        self.assertEqual(CodeAnnotation.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(AnnotationCount.objects.for_directory('/'), {'a b.py': 3, 'c.py': 1})
+        # Anchored to the file if there is one.
+        anchors = dict(CodeAnnotation.objects.filter(user=self.user).values_list('path', 'snapshot'))
+        self.assertTrue(anchors['/a b.py'])
+        self.assertEqual(anchors['/c.py'], '')
+
+    def test_snapshots_are_read_once_per_batch(self):
+        records = [('/a b.py', line_number, 'Note {}.'.format(line_number)) for line_number in range(1, 7)]
+        with mock.patch('apps.web.bulk.read_snapshot', side_effect=read_snapshot) as read:
+            self.assertEqual(import_annotations(records, self.user, batch_size=3), (6, 0))
+        self.assertEqual(read.call_count, 2)
+
+    def test_invalid_records(self):
+        for record in ({'path': 'a.py', 'line_number': 1, 'annotation': 'x'},
+                       {'path': '/../a.py', 'line_number': 1, 'annotation': 'x'},
+                       {'path': '/a.py', 'line_number': 0, 'annotation': 'x'},
+                       {'path': '/a.py', 'line_number': 1, 'annotation': ' '}):
+            with self.assertRaises(InvalidRecord):
+                list(read_jsonl([json.dumps(record)]))
+
+    def test_sarif_round_trip(self):
+        records = [('/a b.py', 2, 'Note.', 'user')]
+        log = ''.join(write_records(iter(records), 'sarif'))
+        self.assertIn('"uri": "a%20b.py"', log)
+        self.assertEqual(list(read_sarif(log)), [('/a b.py', 2, 'Note.')])
+
+    def test_sarif_file_uri(self):
+        log = json.dumps({'runs': [{'results': [{
+            'ruleId': 'E1', 'message': {'text': 'Note.'},
+            'locations': [{'physicalLocation': {'artifactLocation': {'uri': 'file://' + self.directory + '/a%20b.py'},
+                                                'region': {'startLine': 1}}}],
+        }]}]})
+        self.assertEqual(list(read_sarif(log)), [('/a b.py', 1, '[E1] Note.')])
+        with self.assertRaises(InvalidRecord):
+            list(read_sarif(log.replace(self.directory, '/elsewhere')))
+
+    def test_export(self):
+        CodeAnnotation.objects.create(path='/a b.py', line_number=1, user=self.user, annotation='One.')
+        CodeAnnotation.objects.create(path='/other.py', line_number=1, user=self.user, annotation='Two.')
+        records = list(export_annotations(CodeAnnotation.objects.filter(path__startswith='/a'), batch_size=1))
+        self.assertEqual(records, [('/a b.py', 1, 'One.', 'user')])
+        self.assertEqual(json.loads(''.join(write_records(iter(records), 'jsonl'))),
+                         {'path': '/a b.py', 'line_number': 1, 'annotation': 'One.', 'user': 'user'})
+
+    def test_no_import_over_http(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('web:annotations'), '{}', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 405)
+
+
+class CodeAnnotationTests(TestCase):
+    def test_path_length(self):
+        user = User.objects.create(username='user')
+        # 1000 two byte characters: short enough for the field, too long for the index.
+        annotation = CodeAnnotation(path='/' + '\xe9' * 1000, line_number=1, user=user, annotation='Note.')
+        with self.assertRaises(ValidationError) as raised:
+            annotation.full_clean()
+        self.assertEqual(list(raised.exception.error_dict), ['path'])
+        annotation.path = annotation.path[:-1]
+        annotation.full_clean()
+
+
+class ResolveFileTests(SimpleTestCase):
+    def setUp(self):
+        self.parent = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.parent)
+        self.directory = os.path.join(self.parent, 'code')
+        os.makedirs(os.path.join(self.directory, 'sub'))
+        for path in ('code/sub/a.py', 'secret.py'):
+            with open(os.path.join(self.parent, path), 'w') as f:
+                f.write('print(1)\n')
+        os.symlink('sub/a.py', os.path.join(self.directory, 'inside.py'))
+        os.symlink('../secret.py', os.path.join(self.directory, 'outside.py'))
+        settings = override_settings(CODE_DIRECTORY=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_file(self):
+        absolute_path = os.path.join(os.path.realpath(self.directory), 'sub', 'a.py')
+        self.assertEqual(resolve_file('/sub/a.py'), (absolute_path, '/sub/a.py', None))
+        self.assertEqual(resolve_file('/sub//./a.py'), (absolute_path, '/sub/a.py', None))
+        # Links inside CODE_DIRECTORY resolve to their target.
+        self.assertEqual(resolve_file('/inside.py'), (absolute_path, '/sub/a.py', None))
+
+    def test_outside(self):
+        for path in ('sub/a.py', '/../secret.py', '/sub/../../secret.py', '/outside.py', '/sub', '/missing.py'):
+            with self.assertRaises(KeyError):
+                resolve_file(path)
+
+
+@override_settings(CODE_ENCODING='', CODE_FALLBACK_ENCODING='latin-1')
+class EncodingTests(SimpleTestCase):
+    def test_sniff(self):
+        self.assertEqual(sniff_encoding('\xe9\n'.encode('utf-16')), 'utf-16')
+        self.assertEqual(sniff_encoding('\xe9\n'.encode('utf-32')), 'utf-32')
+        self.assertEqual(sniff_encoding('\ufeff\xe9\n'.encode('utf-8')), 'utf-8')
+        self.assertEqual(sniff_encoding(b'\x7fELF\x02\x00'), None)
+        # Cut in the middle of a character.
+        self.assertEqual(sniff_encoding('\xe9\n'.encode('utf-8')[:1]), 'utf-8')
+        self.assertEqual(sniff_encoding('\xe9\n'.encode('latin-1')), 'latin-1')
+        with self.settings(CODE_ENCODING='cp1252'):
+            self.assertEqual(sniff_encoding('\xe9\n'.encode('utf-8')), 'cp1252')
+
+    def test_line_encoding(self):
+        self.assertTrue(is_line_encoding('utf-8'))
+        self.assertFalse(is_line_encoding('utf-16'))
+
+
+class PlaceholderTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.files = {'/a.bin': b'\x7fELF\x02\x00', '/b.txt': '\xe9\n'.encode('utf-16'), '/c.py': b'print(1)\n'}
+        for path, data in self.files.items():
+            with open(self.directory + path, 'wb') as f:
+                f.write(data)
+        settings = override_settings(CODE_DIRECTORY=self.directory, CODE_REVISION='', CODE_ENCODING='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def annotate(self, path):
+        return self.client.get(reverse('web:annotate'), {'path': path})
+
+    def test_placeholders(self):
+        for path, reason in (('/a.bin', 'binary'), ('/b.txt', 'encoding')):
+            response = self.annotate(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['reason'], reason)
+            self.assertContains(response, reverse('web:download') + '?path=' + path)
+        with self.settings(ANNOTATE_MAX_FILE_SIZE=4):
+            self.assertEqual(self.annotate('/c.py').context['reason'], 'size')
+        self.assertNotIn('reason', self.annotate('/c.py').context)
+
+    def test_download(self):
+        response = self.client.get(reverse('web:download'), {'path': '/a.bin'})
+        self.assertEqual(b''.join(response.streaming_content), self.files['/a.bin'])
+        self.assertEqual(response['Content-Disposition'], "attachment; filename*=UTF-8''a.bin")
+        self.assertEqual(self.client.get(reverse('web:download'), {'path': '/../a.bin'}).status_code, 404)
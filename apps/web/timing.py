@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Timings(object):
+    """
+    Durations of the stages of a request and facts about it (file size,
+    cache hit or miss, ...) for the Server-Timing header and the log line
+    written by apps.web.middleware.TimingMiddleware.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.info = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        return ', '.join('{};dur={:.1f}'.format(name, duration * 1000) for name, duration in self.stages.items())
+
+
+class NullTimings(Timings):
+    """
+    Timings of requests which are not measured, e.g. when REQUEST_TIMING is
+    off, so views can always time their stages.
+    """
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+def get_timings(request):
+    return getattr(request, 'timings', None) or NullTimings()
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Latency histograms of the stages of every view, exported in the
+    Prometheus text format. The histograms are kept per process, every
+    worker process exports its own.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, view, timings, total):
+        with self.lock:
+            for stage, duration in list(timings.stages.items()) + [('total', total)]:
+                self.histograms.setdefault((view, stage), Histogram()).observe(duration)
+
+    def export(self):
+        lines = [
+            '# HELP code_annotate_stage_seconds Duration of the stages of the requests.',
+            '# TYPE code_annotate_stage_seconds histogram',
+        ]
+        with self.lock:
+            for (view, stage), histogram in sorted(self.histograms.items()):
+                labels = 'view="{}",stage="{}"'.format(view, stage)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('code_annotate_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+                lines.append('code_annotate_stage_seconds_sum{{{}}} {}'.format(labels, histogram.sum))
+                lines.append('code_annotate_stage_seconds_count{{{}}} {}'.format(labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -4,6 +4,14 @@ from . import views
 
 urlpatterns = [
     url('^browse/$', views.BrowseView.as_view(), name='browse'),
+    url('^tree/$', views.TreeView.as_view(), name='tree'),
     url('^annotate/$', views.AnnotateView.as_view(), name='annotate'),
+    url('^annotate/lines/$', views.AnnotateLinesView.as_view(), name='annotate_lines'),
+    url('^download/$', views.DownloadView.as_view(), name='download'),
+    url('^summary/$', views.SummaryView.as_view(), name='summary'),
+    url('^diff/$', views.DiffView.as_view(), name='diff'),
+    url('^annotations/$', views.AnnotationsView.as_view(), name='annotations'),
+    url('^search/$', views.SearchView.as_view(), name='search'),
+    url('^metrics/$', views.MetricsView.as_view(), name='metrics'),
     url('^submit/$', views.SubmitView.as_view(), name='submit'),
 ]
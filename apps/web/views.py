@@ -1,23 +1,87 @@
+import hashlib
 import os
-from fnmatch import fnmatch
-from operator import itemgetter
+import posixpath
+from datetime import datetime
+from itertools import chain
+from urllib.parse import quote
 
 from django.conf import settings
+from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.urlresolvers import reverse
-from django.http.response import Http404
+from django.http.response import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect
-from django.views.generic import TemplateView, CreateView
-
-from pygments import highlight
-from pygments.lexers import get_lexer_for_filename
-from pygments.formatters.html import HtmlFormatter
-from pygments.lexers.special import TextLexer
-from pygments.util import ClassNotFound
-
-from apps.web.models import CodeAnnotation
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from django.views.generic import CreateView, TemplateView, View
+
+from apps.web.bulk import CONTENT_TYPES, FORMATS, export_annotations, write_records
+from apps.web.diff import read_raw_lines, side_by_side
+from apps.web.encoding import detect_encoding, is_line_encoding
+from apps.web.excerpts import get_line_index
+from apps.web.forms import CodeAnnotationForm
+from apps.web.git import GitError, get_revision, normalize_path, resolve_revision
+from apps.web.highlighting import (
+    FORMATTER_OPTIONS, Formatter, get_cache_path, highlight_lines, highlight_window, iter_highlighted, join_chunks,
+)
+from apps.web.lexing import get_lexer, read_lines
+from apps.web.listing import list_directory
+from apps.web.models import AnnotationCount, CodeAnnotation
+from apps.web.paths import resolve_file
+from apps.web.search import CodeIndex
+from apps.web.summary import (
+    CONTENT_TYPES as SUMMARY_CONTENT_TYPES, FORMATS as SUMMARY_FORMATS, format_cursor, iter_files, parse_cursor,
+    read_page, summarize, write_summary,
+)
+from apps.web.timing import get_timings, metrics
 
 
 class BaseView(TemplateView):
+    def dispatch(self, request, *args, **kwargs):
+        """
+        Answer 304 Not Modified to conditional requests for pages which did
+        not change, see ``get_validators``.
+        """
+        with get_timings(request).stage('validate'):
+            etag, last_modified = self.get_validators()
+        view = condition(etag_func=lambda *args, **kwargs: etag,
+                         last_modified_func=lambda *args, **kwargs: last_modified)(super(BaseView, self).dispatch)
+        response = view(request, *args, **kwargs)
+        if response.has_header('ETag'):
+            # Pages depend on the user, and should be revalidated when going
+            # back to them.
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def get_validators(self):
+        """
+        Return the ETag and the last modification time of the page, computed
+        without rendering it, or None if it cannot tell.
+        """
+        return None, None
+
+    def render_to_response(self, context, **response_kwargs):
+        # Render here instead of after the view returns, to time it.
+        response = super(BaseView, self).render_to_response(context, **response_kwargs)
+        with get_timings(self.request).stage('template'):
+            response.render()
+        return response
+
+    def get_revision(self):
+        """
+        Return the CODE_REVISION shown by the view, or None for the working
+        tree, resolved once per request.
+        """
+        if not hasattr(self, '_revision'):
+            self._revision = get_revision()
+        return self._revision
+
+    def get_etag(self, *parts):
+        # The CSRF token is part of the forms on the page.
+        parts += (self.request.user.pk, self.request.META.get('CSRF_COOKIE'), self.request.GET.urlencode())
+        return hashlib.sha1(repr(parts).encode('utf-8', 'surrogateescape')).hexdigest()
+
     def get_breadcrumbs(self, path):
         breadcrumbs = [{'path': '/', 'name': 'Root'}]
         if path != '':
@@ -33,13 +97,61 @@ class BrowseView(BaseView):
 
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
-        code_directory = os.path.realpath(settings.CODE_DIRECTORY) + os.path.sep
-        absolute_path = self.request.GET.get('path')
-        if not absolute_path:
+        if not self.request.GET.get('path'):
             return redirect(reverse('web:browse') + '?path=/')
-        if not absolute_path.startswith('/'):
+        timings = get_timings(request)
+        with timings.stage('directory'):
+            absolute_path, relative_path = self.get_directory(self.request.GET['path'])
+        breadcrumbs = self.get_breadcrumbs(relative_path[:-1])
+        parent_directory = posixpath.dirname(relative_path.rstrip('/')).rstrip('/') + '/'
+
+        files, directories = self.get_files_directories(absolute_path, relative_path)
+        timings.info.update(files=len(files), directories=len(directories))
+
+        context.update({
+            'files': files,
+            'directories': directories,
+            'relative_path': relative_path,
+            'parent_directory': parent_directory,
+            'breadcrumbs': breadcrumbs,
+        })
+        return self.render_to_response(context)
+
+    def get_validators(self):
+        # The page changes with the directory listing, including the sizes
+        # of the files which change without the directory, and with the
+        # annotation counts. The listing is kept for the page.
+        try:
+            absolute_path, relative_path = self.get_directory(self.request.GET.get('path', ''))
+        except Http404:
+            return None, None
+        listing = self.get_listing(absolute_path, relative_path)
+        counts = sorted(AnnotationCount.objects.for_directory(relative_path).items())
+        return self.get_etag(relative_path, listing, counts), None
+
+    def get_directory(self, path):
+        """
+        Return the absolute and relative path of the directory. With
+        CODE_REVISION the absolute path is None, the sha of the tree of the
+        directory is stored in ``self.tree``.
+        """
+        revision = self.get_revision()
+        if revision is not None:
+            if not path.startswith('/'):
+                raise Http404
+            try:
+                self.tree, object_type, size = revision.info(path)
+            except KeyError:
+                raise Http404
+            if object_type != 'tree':
+                raise Http404
+            relative_path = normalize_path(path)
+            return None, '/{}/'.format(relative_path) if relative_path else '/'
+
+        code_directory = os.path.realpath(settings.CODE_DIRECTORY) + os.path.sep
+        if not path.startswith('/'):
             raise Http404
-        absolute_path = '.' + absolute_path
+        absolute_path = '.' + path
         absolute_path = os.path.join(settings.CODE_DIRECTORY, absolute_path)
         absolute_path = os.path.realpath(absolute_path) + os.path.sep
 
@@ -53,127 +165,506 @@ class BrowseView(BaseView):
             raise Http404
 
         relative_path = '/' + absolute_path[len(code_directory):]
-        breadcrumbs = self.get_breadcrumbs(relative_path[:-1])
-
-        parent_directory = os.path.realpath(os.path.join(absolute_path, os.path.pardir)) + os.path.sep
-        parent_directory = '/' + parent_directory[len(code_directory):]
-
-        files, directories = self.get_files_directories(absolute_path, relative_path)
-
-        context.update({
-            'files': files,
-            'directories': directories,
-            'relative_path': relative_path,
-            'parent_directory': parent_directory,
-            'breadcrumbs': breadcrumbs,
-        })
-        return self.render_to_response(context)
+        return absolute_path, relative_path
 
     def get_files_directories(self, absolute_path, relative_path):
-        directories = []
-        files = []
-
-        annotations = set(CodeAnnotation.objects.values_list('path', flat=True).distinct())
+        """
+        Return the files and directories of the directory with the number of
+        annotations of each, the counts of the whole subtrees are read with a
+        single query.
+        """
+        timings = get_timings(self.request)
+        with timings.stage('annotations'):
+            annotations = AnnotationCount.objects.for_directory(relative_path)
+        with timings.stage('listing'):
+            files, directories = self.get_listing(absolute_path, relative_path)
+        files = [{'file': f, 'size': size, 'annotations': annotations.get(f, 0)} for f, size in files]
+        directories = [{'directory': d, 'annotations': annotations.get(d, 0)} for d in directories]
+        return files, directories
 
-        everything = os.listdir(absolute_path)
-        everything = (n for n in everything if not any(fnmatch(n, ignore) for ignore in settings.FILE_EXCLUDE_PATTERNS))
+    def get_listing(self, absolute_path, relative_path):
+        """
+        Return the files and directories shown by the page, listed once per
+        request.
+        """
+        if not hasattr(self, '_listing'):
+            self._listing = self.list_directory(absolute_path, relative_path)
+        return self._listing
+
+    def list_directory(self, absolute_path, relative_path, start=0, stop=None):
+        """
+        Return the files and directories of the directory, the sizes of
+        ``files[start:stop]`` are current (see ``listing.list_directory``).
+        """
+        revision = self.get_revision()
+        if revision is not None:
+            return revision.list_directory(relative_path)
+        return list_directory(absolute_path, start, stop)
+
+
+class TreeView(BrowseView):
+    """
+    Return the content of a directory as JSON, used to lazily expand the
+    directory tree on the browse page. Large directories are returned
+    TREE_PAGE_SIZE entries at a time.
+    """
+    def get(self, request, *args, **kwargs):
+        absolute_path, relative_path = self.get_directory(self.request.GET.get('path', ''))
+        annotations = AnnotationCount.objects.for_directory(relative_path)
+        files, directories, total = self.get_listing(absolute_path, relative_path)
+
+        nodes = [
+            {'name': d, 'path': relative_path + d + '/', 'directory': True, 'annotations': annotations.get(d, 0)}
+            for d in directories
+        ]
+        nodes += [
+            {'name': f, 'path': relative_path + f, 'directory': False, 'size': size,
+             'annotations': annotations.get(f, 0)}
+            for f, size in files
+        ]
+        return JsonResponse({
+            'path': relative_path,
+            'offset': self.get_offset(),
+            'total': total,
+            'nodes': nodes,
+        })
 
-        for f in everything:
-            path = os.path.join(absolute_path, f)
-            rel_path = relative_path + f
-            if os.path.isdir(path):
-                has_annotations = any(annotation.startswith(rel_path) for annotation in annotations)
-                directories.append({'directory': f, 'has_annotations': has_annotations})
-            else:
-                files.append({'file': f, 'has_annotations': rel_path in annotations})
+    def get_offset(self):
+        try:
+            return max(int(self.request.GET.get('offset', 0)), 0)
+        except ValueError:
+            raise Http404
 
-        files = sorted(files, key=itemgetter('file'))
-        directories = sorted(directories, key=itemgetter('directory'))
-        return files, directories
+    def get_listing(self, absolute_path, relative_path):
+        """
+        Return the files and directories of the page, the directories come
+        first, and the number of entries of the directory. Only the sizes
+        of the files of the page are read.
+        """
+        if not hasattr(self, '_listing'):
+            offset = self.get_offset()
+            end = offset + settings.TREE_PAGE_SIZE
+            directory_count = len(self.list_directory(absolute_path, relative_path, 0, 0)[1])
+            start, stop = max(offset - directory_count, 0), max(end - directory_count, 0)
+            files, directories = self.list_directory(absolute_path, relative_path, start, stop)
+            self._listing = files[start:stop], directories[offset:end], len(files) + len(directories)
+        return self._listing
 
 
 class AnnotateView(BaseView):
     template_name = 'web/annotate.html'
+    placeholder_template_name = 'web/placeholder.html'
 
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
-        code_directory = os.path.realpath(settings.CODE_DIRECTORY) + os.path.sep
-        absolute_path = self.request.GET.get('path')
-        if not absolute_path:
+        if not self.request.GET.get('path'):
             return redirect(reverse('web:browse') + '?path=/')
-        if not absolute_path.startswith('/'):
-            raise Http404
-        absolute_path = '.' + absolute_path
-        absolute_path = os.path.join(settings.CODE_DIRECTORY, absolute_path)
-        absolute_path = os.path.realpath(absolute_path)
+        timings = get_timings(request)
+        with timings.stage('file'):
+            absolute_path, relative_path = self.get_file(self.request.GET['path'])
+            file_size = os.path.getsize(absolute_path)
+        breadcrumbs = self.get_breadcrumbs(relative_path)
 
-        if not absolute_path.startswith(code_directory):
+        with timings.stage('detect'):
+            reason = self.get_placeholder_reason(absolute_path, file_size)
+        if reason is not None:
+            timings.info.update(file_size=file_size, placeholder=reason)
+            context.update({
+                'relative_path': relative_path,
+                'breadcrumbs': breadcrumbs,
+                'reason': reason,
+                'file_size': file_size,
+            })
+            self.template_name = self.placeholder_template_name
+            return self.render_to_response(context)
+
+        with timings.stage('annotations'):
+            annotations = CodeAnnotation.objects.for_file(relative_path, absolute_path)
+        with timings.stage('lexer'):
+            lexer = get_lexer(absolute_path, posixpath.basename(relative_path))
+        with timings.stage('count'):
+            line_count = get_line_index(absolute_path).line_count
+        start, end = self.get_window(line_count)
+        timings.info.update(file_size=file_size, line_count=line_count, lexer=lexer.name,
+                            annotations=sum(len(line_annotations) for line_annotations in annotations.values()))
+
+        context.update({
+            'relative_path': relative_path,
+            'breadcrumbs': breadcrumbs,
+            'start': start,
+            'end': end,
+            'line_count': line_count,
+            'events_url': settings.ANNOTATION_EVENTS_URL,
+        })
+        if settings.ANNOTATION_EVENTS_URL:
+            with timings.stage('annotations'):
+                context['last_annotation_id'] = CodeAnnotation.objects.last_id(relative_path)
+
+        if (start, end) != (1, line_count):
+            with timings.stage('highlight'):
+                lines = highlight_window(absolute_path, self.get_cache_path(relative_path), lexer, start, end,
+                                         timings.info)
+            with timings.stage('format'):
+                formatter = Formatter(annotations, line_count, linenostart=start, **FORMATTER_OPTIONS)
+                context['code'] = formatter.render(lines)
+            return self.render_to_response(context)
+
+        if file_size > settings.HIGHLIGHT_STREAMING_THRESHOLD:
+            timings.info['cache'] = 'streamed'
+            return self.stream_response(context, absolute_path, lexer, annotations)
+
+        with timings.stage('highlight'):
+            lines = highlight_lines(absolute_path, self.get_cache_path(relative_path), lexer, timings.info)
+        with timings.stage('format'):
+            context['code'] = Formatter(annotations, line_count, **FORMATTER_OPTIONS).render(lines)
+        return self.render_to_response(context)
+
+    def get_validators(self):
+        # Only the metadata of the file is used, not its content.
+        try:
+            absolute_path, relative_path = self.get_file(self.request.GET.get('path', ''))
+        except Http404:
+            return None, None
+        stat = os.stat(absolute_path)
+        updated, count = CodeAnnotation.objects.version(relative_path)
+        # The copies of git blobs all have the same modification time. The
+        # time of the latest annotation goes back when it is deleted, so
+        # annotated files only get the ETag, which has the count.
+        last_modified = None
+        if not self.blob and not count:
+            last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        etag = self.get_etag(relative_path, self.blob, stat.st_mtime_ns, stat.st_size, updated, count,
+                             settings.ANNOTATION_EVENTS_URL)
+        return etag, last_modified
+
+    def get_file(self, path):
+        """
+        Return the absolute and relative path of the file. With CODE_REVISION
+        the absolute path is the one of the copy of its blob, whose sha is
+        stored in ``self.blob``.
+        """
+        try:
+            absolute_path, relative_path, self.blob = resolve_file(path, self.get_revision())
+        except KeyError:
+            raise Http404
+        return absolute_path, relative_path
+
+    def get_placeholder_reason(self, absolute_path, file_size):
+        """
+        Return why the file is not shown but linked to ('size', 'binary' or
+        'encoding'), or None to show it. Files too large are not opened.
+        """
+        if settings.ANNOTATE_MAX_FILE_SIZE and file_size > settings.ANNOTATE_MAX_FILE_SIZE:
+            return 'size'
+        encoding = detect_encoding(absolute_path)
+        if encoding is None:
+            return 'binary'
+        if not is_line_encoding(encoding):
+            return 'encoding'
+        return None
+
+    def get_cache_path(self, relative_path):
+        return get_cache_path(relative_path, self.blob)
+
+    def get_window(self, line_count):
+        """
+        Return the first and last line to show, files with more than
+        ANNOTATE_WINDOW_LINES lines are shown one window at a time. A larger
+        range asked for with ``end`` is cut to one window.
+        """
+        window = settings.ANNOTATE_WINDOW_LINES
+        try:
+            start = max(int(self.request.GET.get('start', 1)), 1)
+            end = int(self.request.GET.get('end', start + window - 1 if window else line_count))
+        except ValueError:
             raise Http404
+        start = min(start, max(line_count, 1))
+        if window:
+            end = min(end, start + window - 1)
+        return start, min(max(end, start), line_count)
+
+    def stream_response(self, context, absolute_path, lexer, annotations):
+        """
+        Send the page around the code first and then the code while it is
+        highlighted, without ever holding the whole file in memory.
+        """
+        placeholder = '<!-- code -->'
+        context['code'] = placeholder
+        with get_timings(self.request).stage('template'):
+            page = render_to_string(self.template_name, context, request=self.request)
+        head, tail = page.split(placeholder, 1)
+
+        formatter = Formatter(annotations, get_line_index(absolute_path).line_count, **FORMATTER_OPTIONS)
+        code = formatter.stream(iter_highlighted(read_lines(absolute_path), lexer))
+        return StreamingHttpResponse(chain([head], join_chunks(code), [tail]))
+
+
+class AnnotateLinesView(AnnotateView):
+    """
+    Return a window of the highlighted lines of a file as JSON, used to load
+    more lines while scrolling through a large file.
+    """
+    def get(self, request, *args, **kwargs):
+        absolute_path, relative_path = self.get_file(self.request.GET.get('path', ''))
+        if self.get_placeholder_reason(absolute_path, os.path.getsize(absolute_path)) is not None:
+            raise Http404
+        line_count = get_line_index(absolute_path).line_count
+        start, end = self.get_window(line_count)
+
+        lexer = get_lexer(absolute_path, posixpath.basename(relative_path))
+        lines = highlight_window(absolute_path, self.get_cache_path(relative_path), lexer, start, end)
+        annotations = CodeAnnotation.objects.for_file(relative_path, absolute_path)
+        formatter = Formatter(annotations, line_count, linenostart=start, **FORMATTER_OPTIONS)
+        return JsonResponse({
+            'start': start,
+            'end': end,
+            'line_count': line_count,
+            'lines': ''.join(formatter.iter_lines(lines)),
+        })
 
-        if not os.path.exists(absolute_path):
+
+class DownloadView(AnnotateView):
+    """
+    Send the file as it is, linked to instead of the files the annotate page
+    does not show.
+    """
+    def get(self, request, *args, **kwargs):
+        absolute_path, relative_path = self.get_file(self.request.GET.get('path', ''))
+        response = FileResponse(open(absolute_path, 'rb'), content_type='application/octet-stream')
+        response['Content-Length'] = os.path.getsize(absolute_path)
+        response['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(
+            quote(posixpath.basename(relative_path)))
+        return response
+
+
+class DiffView(BaseView):
+    """
+    Show the difference of a file between the revision ``from`` and the
+    revision ``to`` (by default CODE_REVISION or the working tree) side by
+    side, with the annotations on the new lines. Only the changed lines and
+    their context are highlighted.
+    """
+    template_name = 'web/diff.html'
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        path = self.request.GET.get('path', '')
+        old_revision = self.request.GET.get('from', '')
+        new_revision = self.request.GET.get('to', '')
+        if not path.startswith('/') or not old_revision:
             raise Http404
+        try:
+            relative_path = '/' + normalize_path(path)
+        except KeyError:
+            raise Http404
+        timings = get_timings(request)
+
+        with timings.stage('file'):
+            old_path = self.get_version(relative_path, old_revision)
+            new_path = self.get_version(relative_path, new_revision)
+            if old_path is None and new_path is None:
+                raise Http404
+        with timings.stage('detect'):
+            encodings = [detect_encoding(path) if path else 'utf-8' for path in (old_path, new_path)]
+        context.update({
+            'relative_path': relative_path,
+            'breadcrumbs': self.get_breadcrumbs(relative_path),
+            'old_revision': old_revision,
+            'new_revision': new_revision,
+        })
+        if not all(encoding and is_line_encoding(encoding) for encoding in encodings):
+            context['binary'] = True
+            return self.render_to_response(context)
+
+        with timings.stage('file'):
+            old, new = read_raw_lines(old_path), read_raw_lines(new_path)
+        with timings.stage('annotations'):
+            annotations = CodeAnnotation.objects.for_file(relative_path, new_path) if new_path else {}
+        with timings.stage('lexer'):
+            lexer = get_lexer(new_path or old_path, posixpath.basename(relative_path))
+        with timings.stage('highlight'):
+            hunks = side_by_side(old, new, lexer, settings.DIFF_CONTEXT_LINES, *encodings)
+
+        formatter = Formatter(annotations, len(new), **FORMATTER_OPTIONS)
+        context.update({
+            'hunks': [
+                [{
+                    'old_number': old_number,
+                    'old_line': old_line and old_line.rstrip('\n'),
+                    'new_number': new_number,
+                    'new_line': new_line and new_line.rstrip('\n'),
+                    'tag': tag,
+                    'marker': formatter.annotation_marker(new_number) if new_number in annotations else '',
+                } for old_number, old_line, new_number, new_line, tag in rows]
+                for rows in hunks
+            ],
+        })
+        timings.info.update(old_lines=len(old), new_lines=len(new), hunks=len(hunks))
+        return self.render_to_response(context)
 
-        if not os.path.isfile(absolute_path):
+    def get_version(self, relative_path, revision):
+        """
+        Return the absolute path of the file at the revision, or None if the
+        revision has no such file. Without revision, the file is read like
+        on the annotate page. There is no page if CODE_DIRECTORY is not a
+        git repository or git cannot be run.
+        """
+        try:
+            if not revision:
+                try:
+                    return resolve_file(relative_path, self.get_revision())[0]
+                except KeyError:
+                    return None
+            try:
+                revision = resolve_revision(revision)
+            except KeyError:
+                raise Http404
+            try:
+                return revision.blob_path(relative_path)[1]
+            except KeyError:
+                return None
+        except (GitError, OSError):
             raise Http404
 
-        relative_path = '/' + absolute_path[len(code_directory):]
-        breadcrumbs = self.get_breadcrumbs(relative_path)
 
-        annotations = {}
-        for annotation in CodeAnnotation.objects.filter(path=relative_path):
-            annotations[annotation.line_number] = {'user': annotation.user, 'annotation': annotation.annotation}
+class SummaryView(BaseView):
+    """
+    List the annotations of the files below ``path`` grouped by file, with
+    the number of annotations of every author and the annotated lines, one
+    page at a time. With ``format`` set to csv or json, all annotations are
+    exported instead.
+    """
+    template_name = 'web/summary.html'
 
-        with open(absolute_path) as f:
-            code = f.read()
+    def get(self, request, *args, **kwargs):
+        prefix = self.request.GET.get('path', '/')
+        if not prefix.startswith('/'):
+            raise Http404
+        format = self.request.GET.get('format')
+        if format is not None:
+            if format not in SUMMARY_FORMATS:
+                raise Http404
+            response = StreamingHttpResponse(write_summary(iter_files(prefix), format),
+                                             content_type=SUMMARY_CONTENT_TYPES[format])
+            response['Content-Disposition'] = 'attachment; filename="summary.{}"'.format(format)
+            return response
 
         try:
-            lexer = get_lexer_for_filename(absolute_path)
-        except ClassNotFound:
-            lexer = TextLexer()
-        code = highlight(code, lexer, Formatter(annotations=annotations, linenos='inline', linespans='line'))
-
+            after = parse_cursor(self.request.GET['after']) if self.request.GET.get('after') else None
+        except ValueError:
+            raise Http404
+        timings = get_timings(request)
+        with timings.stage('annotations'):
+            rows, last = read_page(prefix, after)
+        with timings.stage('summary'):
+            files = summarize(rows)
+        context = self.get_context_data(**kwargs)
         context.update({
-            'code': code,
-            'css': HtmlFormatter().get_style_defs('.highlight'),
-            'relative_path': relative_path,
-            'breadcrumbs': breadcrumbs,
+            'relative_path': prefix,
+            'breadcrumbs': self.get_breadcrumbs(prefix.rstrip('/')),
+            'files': files,
+            'next_cursor': format_cursor(*last) if last else None,
         })
         return self.render_to_response(context)
 
 
-class Formatter(HtmlFormatter):
-    def __init__(self, annotations, **options):
-        super(Formatter, self).__init__(**options)
-        self.annotations = annotations
-
-    def _wrap_linespans(self, inner):
-        s = self.linespans
-        i = self.linenostart - 1
-        for t, line in inner:
-            if t:
-                i += 1
-                if i in self.annotations:
-                    annotation = self.annotations[i]
-                    tooltip = '<span data-toggle="tooltip" data-placement="left" data-toggle="tooltip" ' + \
-                              'title="{}: {}" class="annotation"><i class="fa fa-comment fa-fw"> </i> </span>'
-                    tooltip = tooltip.format(annotation['user'].get_full_name(), annotation['annotation'])
-                    yield 1, '<span id="%s-%d">%s%s</span>' % (s, i, tooltip, line)
-                else:
-                    yield 1, '<span id="%s-%d"><span class="fa fa-fw"></span> %s</span>' \
-                          % (s, i, line)
-            else:
-                yield 0, line
+class SearchView(BaseView):
+    """
+    Search the annotations and the code, the code is searched with the index
+    built by the build_search_index management command.
+    """
+    template_name = 'web/search.html'
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        context['query'] = query
+        if query:
+            index = CodeIndex()
+            annotations = list(CodeAnnotation.objects.search(query).order_by('path', 'line_number', 'id').values_list(
+                'id', 'line_number', 'path', 'user__first_name', 'user__last_name', 'annotation', 'snapshot',
+                'fingerprint')[:settings.SEARCH_MAX_RESULTS])
+            # Link to the lines the annotations are on now.
+            moved = CodeAnnotation.objects.current_lines(annotations)
+            context.update({
+                'annotations': [
+                    {'path': path, 'line_number': moved.get(pk, line_number),
+                     'author': '{} {}'.format(first_name, last_name).strip(), 'annotation': annotation}
+                    for pk, line_number, path, first_name, last_name, annotation, snapshot, line_fingerprint in
+                    annotations
+                ],
+                'index_exists': index.exists(),
+                'lines': [{'path': path, 'line_number': line_number, 'line': line}
+                          for path, line_number, line in index.search(query, revision=self.get_revision())],
+                'max_results': settings.SEARCH_MAX_RESULTS,
+            })
+        return self.render_to_response(context)
+
+
+class AnnotationsView(LoginRequiredMixin, View):
+    """
+    Export the annotations below ``path`` as JSON Lines or SARIF depending
+    on ``format``. Annotations are imported with the import_annotations
+    management command, tools cannot send the CSRF token a POST would need.
+    """
+    raise_exception = True
+
+    def get_format(self):
+        format = self.request.GET.get('format', 'jsonl')
+        if format not in FORMATS:
+            raise Http404
+        return format
+
+    def get(self, request, *args, **kwargs):
+        format = self.get_format()
+        queryset = CodeAnnotation.objects.filter(path__startswith=self.request.GET.get('path', '/'))
+        response = StreamingHttpResponse(write_records(export_annotations(queryset), format),
+                                         content_type=CONTENT_TYPES[format])
+        response['Content-Disposition'] = 'attachment; filename="annotations.{}"'.format(format)
+        return response
+
+
+class MetricsView(View):
+    """
+    Export the latency histograms of the stages of the requests in the
+    Prometheus text format, if METRICS_ENABLED is set.
+    """
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404
+        return HttpResponse(metrics.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 class SubmitView(CreateView):
-    model = CodeAnnotation
-    fields = ('annotation', 'line_number', 'path')
+    form_class = CodeAnnotationForm
 
     def form_valid(self, form):
         annotation = form.save(commit=False)
         annotation.user = self.request.user
         annotation.save()
+        if self.request.is_ajax():
+            return self.marker_response(annotation)
         return redirect('{}?path={}#line-{}'.format(reverse('web:annotate'), annotation.path, annotation.line_number))
 
     def form_invalid(self, form):
-        print(form.errors)
+        errors = {
+            field: [{'message': ' '.join(error.messages), 'code': error.code} for error in field_errors]
+            for field, field_errors in form.errors.as_data().items()
+        }
+        return JsonResponse({'errors': errors}, status=400)
+
+    def marker_response(self, annotation):
+        """
+        Return the new marker of the annotated line as JSON, which the annotate
+        page puts in place of the old one instead of reloading the file.
+        """
+        try:
+            absolute_path = resolve_file(annotation.path, get_revision())[0]
+        except KeyError:
+            absolute_path = None
+        annotations = CodeAnnotation.objects.for_file(annotation.path, absolute_path)
+        formatter = Formatter(annotations, 0, **FORMATTER_OPTIONS)
+        return JsonResponse({
+            'line_number': annotation.line_number,
+            'marker': formatter.annotation_marker(annotation.line_number),
+        })
@@ -14,3 +14,14 @@ def get_env_variable(var_name, default=None):
         else:
             error_msg = "Set the %s environment variable" % var_name
             raise ImproperlyConfigured(error_msg)
+
+
+def get_bool_env_variable(var_name, default=False):
+    """
+    Get the environment variable as a boolean, "1", "true", "yes" and "on"
+    (in any case) are true, any other value is false
+    """
+    value = os.environ.get(var_name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
@@ -4,7 +4,7 @@ import os
 
 import dj_database_url
 
-from . import get_env_variable
+from . import get_bool_env_variable, get_env_variable
 from .. import get_project_root_path
 
 gettext = lambda s: s
@@ -43,8 +43,13 @@ INTERNAL_IPS = ("127.0.0.1",)
 STATICFILES_FINDERS = (
     "django.contrib.staticfiles.finders.FileSystemFinder",
     "django.contrib.staticfiles.finders.AppDirectoriesFinder",
+    "apps.web.finders.PygmentsStyleFinder",
 )
 
+# Add the hash of their content to the static file names, so they can be
+# served with far-future cache headers.
+STATICFILES_STORAGE = "django.contrib.staticfiles.storage.ManifestStaticFilesStorage"
+
 # The numeric mode to set newly-uploaded files to. The value should be
 # a mode you'd pass directly to os.chmod.
 FILE_UPLOAD_PERMISSIONS = 0o644
@@ -148,6 +153,7 @@ INSTALLED_APPS = (
 # these middleware classes will be applied in the order given, and in the
 # response phase the middleware will be applied in reverse order.
 MIDDLEWARE_CLASSES = (
+    'apps.web.middleware.TimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -163,3 +169,162 @@ FILE_EXCLUDE_PATTERNS = (
     '*.pyc',
     '__pycache__',
 )
+
+# Git revision (commit, branch or tag) of the repository at CODE_DIRECTORY to
+# review instead of the working tree, e.g. to keep a review stable while the
+# checkout moves. Leave empty to show the working tree.
+CODE_REVISION = get_env_variable('CODE_REVISION', '')
+
+# Directory the files of CODE_REVISION are copied to, named by the sha of
+# their content. It can be emptied at any time.
+GIT_BLOB_DIRECTORY = get_env_variable('GIT_BLOB_DIRECTORY', '/tmp/code_annotate-blobs')
+
+# Maximum number of git cat-file processes reading the repository at a time,
+# per kind (objects and object sizes) and worker process.
+GIT_PROCESSES = 4
+
+# Pygments style used to highlight the code, the stylesheet is generated as
+# the static file web/pygments.css.
+PYGMENTS_STYLE = get_env_variable('PYGMENTS_STYLE', 'default')
+
+# Lexers to use for file names Pygments does not know or gets wrong, as
+# (pattern, lexer alias) tuples, e.g. ('*.inc', 'php').
+LEXER_OVERRIDES = ()
+
+# Number of bytes at the start of a file used to guess the lexer when the file
+# name does not tell.
+LEXER_GUESS_BYTES = 4096
+
+# Encoding of the files without a byte order mark. Leave empty to read the
+# files whose start is valid UTF-8 as UTF-8 and the others with
+# CODE_FALLBACK_ENCODING.
+CODE_ENCODING = get_env_variable('CODE_ENCODING', '')
+CODE_FALLBACK_ENCODING = get_env_variable('CODE_FALLBACK_ENCODING', 'latin-1')
+
+# Number of bytes at the start of a file checked for a byte order mark, NUL
+# bytes (binary files) and valid UTF-8.
+ENCODING_SNIFF_BYTES = 8192
+
+# Files larger than this (in bytes) are not shown on the annotate page, which
+# links to a download of the file instead. Set to 0 to show all files.
+ANNOTATE_MAX_FILE_SIZE = int(get_env_variable('ANNOTATE_MAX_FILE_SIZE', str(512 * 1024 * 1024)))
+
+# Maximum number of entries of a directory returned at once by the tree view.
+TREE_PAGE_SIZE = 1000
+
+# Number of annotations shown for a line before the rest is collapsed behind
+# a "show more" link.
+ANNOTATIONS_PER_LINE = 3
+
+# Number of annotations per page of the summary, and number of lines shown
+# before and after every annotated line.
+SUMMARY_PAGE_SIZE = 100
+SUMMARY_EXCERPT_CONTEXT = 1
+
+# Number of unchanged lines shown around the changes on the diff page.
+DIFF_CONTEXT_LINES = 3
+
+# Number of annotations read and written at a time by the bulk import and
+# export.
+ANNOTATION_BATCH_SIZE = 1000
+
+# URL of the serve_annotation_events server, which pushes new annotations to
+# the open annotate pages. It should be served from the same host as the
+# pages, e.g. by proxying /events/ to it. Leave empty to not use it.
+ANNOTATION_EVENTS_URL = get_env_variable('ANNOTATION_EVENTS_URL', '')
+
+# Seconds between two checks for new annotations by the events server.
+ANNOTATION_EVENTS_POLL_INTERVAL = 1.0
+
+
+##########
+# TIMING #
+##########
+
+# Time the stages of the requests, send them in the Server-Timing header and
+# log them with the apps.web.timing logger. Counting the queries makes Django
+# record every query like with DEBUG, so it is off by default.
+REQUEST_TIMING = get_bool_env_variable('REQUEST_TIMING')
+
+# Export latency histograms of the stages in the Prometheus text format at
+# /metrics/. They are kept per worker process, and the requests are timed like
+# with REQUEST_TIMING to fill them.
+METRICS_ENABLED = get_bool_env_variable('METRICS_ENABLED')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'apps.web.timing': {
+            'handlers': ['console'],
+            'level': get_env_variable('REQUEST_TIMING_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+
+##########
+# CACHES #
+##########
+
+# Maximum number of highlighted files kept in the render cache, the files
+# highlighted first are evicted first.
+HIGHLIGHT_CACHE_MAX_ENTRIES = int(get_env_variable('HIGHLIGHT_CACHE_MAX_ENTRIES', '500'))
+
+# Large files are lexed this many lines at a time, which bounds the memory
+# used to highlight them. A single token longer than this (e.g. a huge block
+# comment) may come out differently than when lexing the whole file.
+HIGHLIGHT_CHUNK_LINES = 1000
+
+# Files with more lines are shown this many lines at a time, more lines are
+# loaded while scrolling. Set to None to always show the whole file.
+ANNOTATE_WINDOW_LINES = 5000
+
+# Files larger than this (in bytes) are not cached but highlighted while the
+# response is streamed to the browser.
+HIGHLIGHT_STREAMING_THRESHOLD = int(get_env_variable('HIGHLIGHT_STREAMING_THRESHOLD', str(2 * 1024 * 1024)))
+
+# Cache alias the highlighted files are stored in.
+HIGHLIGHT_CACHE = 'highlight'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Use django.core.cache.backends.filebased.FileBasedCache with a directory
+    # as location to share the rendered files between workers.
+    HIGHLIGHT_CACHE: {
+        'BACKEND': get_env_variable('HIGHLIGHT_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': get_env_variable('HIGHLIGHT_CACHE_LOCATION', 'highlight'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            # Leave room for the eviction of the render cache, the backend
+            # should only cull if the index of the entries is lost.
+            'MAX_ENTRIES': HIGHLIGHT_CACHE_MAX_ENTRIES * 2 + 1,
+        },
+    },
+}
+
+
+##########
+# SEARCH #
+##########
+
+# Trigram index of the code, built and updated with the build_search_index
+# management command.
+SEARCH_INDEX_PATH = get_env_variable('SEARCH_INDEX_PATH', '/tmp/code_annotate-search.sqlite3')
+
+# Files larger than this (in bytes) are not indexed.
+SEARCH_MAX_FILE_SIZE = int(get_env_variable('SEARCH_MAX_FILE_SIZE', str(10 * 1024 * 1024)))
+
+# The index is compacted when an update leaves more segments than this.
+SEARCH_INDEX_MAX_SEGMENTS = 16
+
+# Maximum number of annotations and of code lines shown for a search.
+SEARCH_MAX_RESULTS = 200